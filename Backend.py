@@ -0,0 +1,150 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Exceptions import BackendTimeout
+
+DOCKER_WORKERS = int(os.getenv("DOCKER_WORKERS", "8"))
+LIBVIRT_WORKERS = int(os.getenv("LIBVIRT_WORKERS", "4"))
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "60"))
+STREAM_BUFFER = 64
+
+class AsyncBackend():
+    def __init__(self, backend, name, max_workers, timeout=BACKEND_TIMEOUT):
+        self.backend = backend
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._started = 0
+        self._streams = 0
+        self._counters = {"calls": 0, "errors": 0, "timeouts": 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return method
+
+    async def run(self, func, *args, call_timeout=None, **kwargs):
+        future, state = self._submit(func, args, kwargs)
+        timeout = call_timeout or self.timeout
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(state, timed_out=True)
+            raise BackendTimeout(self.name + " did not answer within " + str(timeout) + "s")
+
+    async def stream(self, func, *args, **kwargs):
+        # Runs a generator on a thread of its own and yields its items. The
+        # producer stops after STREAM_BUFFER unconsumed items, so a slow reader
+        # holds back the backend instead of growing server memory. Streams live
+        # as long as their reader and never occupy a worker of the call executor
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        slots = threading.Semaphore(STREAM_BUFFER)
+        stopped = threading.Event()
+
+        def push(entry):
+            try:
+                loop.call_soon_threadsafe(items.put_nowait, entry)
+            except RuntimeError:
+                stopped.set()
+
+        def produce():
+            iterator = None
+            try:
+                iterator = iter(func(*args, **kwargs))
+                for item in iterator:
+                    while not slots.acquire(timeout=1):
+                        if stopped.is_set():
+                            return
+                    if stopped.is_set():
+                        return
+                    push((False, item))
+                push((True, None))
+            except Exception as e:
+                with self._lock:
+                    self._counters["errors"] += 1
+                push((True, e))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+                with self._lock:
+                    self._streams -= 1
+
+        with self._lock:
+            self._counters["calls"] += 1
+            self._streams += 1
+        threading.Thread(target=produce, name=self.name + "-stream", daemon=True).start()
+        try:
+            while True:
+                finished, item = await items.get()
+                if finished:
+                    if item is not None:
+                        raise item
+                    return
+                slots.release()
+                yield item
+        finally:
+            stopped.set()
+
+    def _submit(self, func, args, kwargs):
+        submitted = time.monotonic()
+        state = {"started": False, "cancelled": False}
+        with self._lock:
+            self._queued += 1
+            self._counters["calls"] += 1
+
+        def task():
+            waited = time.monotonic() - submitted
+            with self._lock:
+                if state["cancelled"]:
+                    return None
+                state["started"] = True
+                self._queued -= 1
+                self._running += 1
+                self._started += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self._counters["errors"] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        return asyncio.get_running_loop().run_in_executor(self.executor, task), state
+
+    def _abandon(self, state, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self._counters["timeouts"] += 1
+            if not state["started"] and not state["cancelled"]:
+                state["cancelled"] = True
+                self._queued -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"name": self.name,
+                    "maxWorkers": self.max_workers,
+                    "timeout": self.timeout,
+                    "queued": self._queued,
+                    "running": self._running,
+                    "streams": self._streams,
+                    **self._counters,
+                    "waitTimeAvg": self._wait_total / self._started if self._started else 0.0,
+                    "waitTimeMax": self._wait_max}
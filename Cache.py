@@ -0,0 +1,83 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from Metrics import registry
+
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "2"))
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "1024"))
+
+READS = registry.counter("read_cache_requests_total", "Cached reads by endpoint and result",
+                         ("endpoint", "result"))
+
+class ReadCache():
+    def __init__(self, ttl=READ_CACHE_TTL, size=READ_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generations = {}
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "evictions": 0}
+        # Inventory listeners invalidate from their watcher threads
+        self._lock = threading.Lock()
+
+    async def get(self, endpoint, key, tags, load):
+        # Identical concurrent reads share one backend call, its result is kept for ttl seconds
+        # unless a write to one of its tags invalidates it first
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                result = "hits"
+            elif key in self._inflight:
+                flight = self._inflight[key][0]
+                result = "coalesced"
+            else:
+                generations = [self._generations.get(tag, 0) for tag in tags]
+                flight = asyncio.ensure_future(load())
+                self._inflight[key] = (flight, set(tags))
+                result = "misses"
+            self._counters[result] += 1
+        READS.labels(endpoint, result).inc()
+        if result == "hits":
+            return entry[1]
+        if result == "coalesced":
+            return await asyncio.shield(flight)
+        try:
+            value = await asyncio.shield(flight)
+        finally:
+            with self._lock:
+                if self._inflight.get(key, (None,))[0] is flight:
+                    del self._inflight[key]
+        with self._lock:
+            if self.ttl > 0 and generations == [self._generations.get(tag, 0) for tag in tags]:
+                self._store(key, tags, value)
+        return value
+
+    def invalidate(self, *tags):
+        tags = set(tags)
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in [key for key, entry in self._entries.items() if tags & entry[2]]:
+                del self._entries[key]
+            # Running loads keep serving their waiters, later reads start a fresh one
+            for key in [key for key, (flight, flight_tags) in self._inflight.items() if tags & flight_tags]:
+                del self._inflight[key]
+            self._counters["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"ttl": self.ttl,
+                    "size": self.size,
+                    "entries": len(self._entries),
+                    "inflight": len(self._inflight),
+                    **self._counters}
+
+    def _store(self, key, tags, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value, set(tags))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import libvirt
+from libvirt import libvirtError
+from Exceptions import ConnectionFailed
+
+LIBVIRT_URI = os.getenv("LIBVIRT_URI", "qemu:///system")
+POOL_SIZE = int(os.getenv("LIBVIRT_POOL_SIZE", "4"))
+POOL_TIMEOUT = float(os.getenv("LIBVIRT_POOL_TIMEOUT", "10"))
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def start_event_loop():
+    # Keepalive and event callbacks need a running event loop, which has
+    # to be registered before the first connection is opened
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is not None:
+            return _event_loop
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop = threading.Thread(target=run, name="libvirt-event-loop", daemon=True)
+        _event_loop.start()
+        return _event_loop
+
+class ConnectionPool():
+    def __init__(self, uri=LIBVIRT_URI, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.uri = uri
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {"opened": 0, "closed": 0, "reconnects": 0, "acquired": 0, "waits": 0}
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            # Backends turn libvirtError into their own exceptions inside the block,
+            # the original error stays reachable as cause or context
+            error = e if isinstance(e, libvirtError) else (e.__cause__ or e.__context__)
+            broken = isinstance(error, libvirtError) and error.get_error_code() == libvirt.VIR_ERR_SYSTEM_ERROR
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                self._counters["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise ConnectionFailed("No libvirt connection available within "
+                                           + str(self.timeout) + "s -> Pool exhausted")
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open += 1
+            self._in_use += 1
+            self._counters["acquired"] += 1
+        if conn is not None and self._is_alive(conn):
+            return conn
+        try:
+            if conn is not None:
+                self._close(conn)
+                self._count("reconnects")
+            return self._connect()
+        except ConnectionFailed:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        alive = not broken and self._is_alive(conn)
+        if not alive:
+            self._close(conn)
+        with self._cond:
+            self._in_use -= 1
+            if alive:
+                self._idle.append(conn)
+            else:
+                self._open -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"uri": self.uri,
+                    "size": self.size,
+                    "open": self._open,
+                    "inUse": self._in_use,
+                    "idle": len(self._idle),
+                    **self._counters}
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def _connect(self):
+        try:
+            conn = libvirt.open(self.uri)
+        except libvirtError:
+            raise ConnectionFailed()
+        try:
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+        except libvirtError:
+            # Local drivers (e.g. test:///default) and setups without an
+            # event loop do not support keepalive
+            pass
+        self._count("opened")
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except libvirtError:
+            pass
+        self._count("closed")
+
+    def _count(self, name):
+        with self._cond:
+            self._counters[name] += 1
+
+    def _is_alive(self, conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirtError:
+            return False
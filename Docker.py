@@ -1,10 +1,15 @@
+from datetime import datetime, timezone
 import docker
 from docker import errors
+from docker.constants import DEFAULT_DOCKER_API_VERSION
+from docker.utils import parse_repository_tag
 from pydantic import BaseModel, Extra
 from Exceptions import (
     APIError, ArgumentNotFound, ImageNotFound, ResourceNotFound, 
     ResourceAlreadyRunning, ResourceNotRunning, ResourceRunning
 )
+from Images import ImageManager
+from Listing import lookup_field
 
 class ContainerObj(BaseModel):
     name: str | None = None
@@ -24,34 +29,97 @@ class ContainerObj(BaseModel):
         extra = Extra.allow
 
 class Docker():
-    def __init__(self):
-        self.client = docker.from_env()
-
-    def list_containers(self):
-        list = self.client.containers.list(all=True)
-        jsonList = []
-        for i in range(0 , list.__len__()):
-            jsonList.append({"Id" : list[i].short_id,
-                            "Name": list[i].attrs['Name'],
-                            "Image": list[i].attrs['Config']['Image'],
-                            "Status": list[i].attrs['State']['Status']})
-        return jsonList
+    # Calls measured by Metrics.instrument, the list_* wrappers only collect their iter_* generator
+    API_METHODS = ("iter_containers", "iter_images", "get_container_summary", "get_container_info",
+                   "open_logs", "start_container", "stop_container", "restart_container", "remove_container",
+                   "prune_containers", "run_container", "pull_image", "list_container_ids")
+
+    def __init__(self, base_url=None, version=None):
+        # Remote daemons get a fixed API version, auto detection would connect right here
+        if base_url:
+            self.client = docker.DockerClient(base_url=base_url, version=version or DEFAULT_DOCKER_API_VERSION)
+        else:
+            self.client = docker.from_env()
+        self.image_manager = ImageManager(self)
+
+    def list_containers(self, filters=None, limit=None, fields=None):
+        return list(self.iter_containers(filters, limit, fields))
     
-    def list_images(self):
-        list = self.client.images.list(all=True)
-        jsonList = []
-        for i in range(0 , list.__len__()):
-            jsonList.append({"Name": list[i].attrs["RepoTags"][0],
-                            "Id" : list[i].attrs["Id"],
-                            "Created": list[i].attrs["Created"],
-                            "Container": list[i].attrs["ContainerConfig"]["Hostname"]
-                            })
-        return jsonList
-
-    def get_container_info(self, id):
+    def list_images(self, filters=None, fields=None):
+        return list(self.iter_images(filters, fields))
+
+    def iter_containers(self, filters=None, limit=None, fields=None):
+        try:
+            containers = self.client.api.containers(all=True, filters=filters, limit=limit or -1)
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        for container in containers:
+            entry = self.build_container_summary(container)
+            if fields:
+                try:
+                    attrs = self.client.api.inspect_container(container["Id"])
+                except errors.NotFound:
+                    continue
+                except errors.APIError as e:
+                    raise APIError(str(e.explanation))
+                entry.update({field: lookup_field(attrs, field) for field in fields})
+            yield entry
+
+    def iter_images(self, filters=None, fields=None):
+        try:
+            images = self.client.api.images(all=True, filters=filters)
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        for image in images:
+            tags = image.get("RepoTags") or ["<none>:<none>"]
+            entry = {"Name": tags[0],
+                     "Id" : image["Id"],
+                     "Created": datetime.fromtimestamp(image["Created"], timezone.utc)
+                                        .isoformat().replace("+00:00", "Z")}
+            if fields:
+                try:
+                    attrs = self.client.api.inspect_image(image["Id"])
+                except errors.NotFound:
+                    continue
+                except errors.APIError as e:
+                    raise APIError(str(e.explanation))
+                entry.update({field: lookup_field(attrs, field) for field in fields})
+            yield entry
+
+    def get_container_summary(self, id):
+        try:
+            containers = self.client.api.containers(all=True, filters={"id": id})
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        if not containers:
+            raise ResourceNotFound()
+        return self.build_container_summary(containers[0])
+
+    def build_container_summary(self, container):
+        # Linked containers carry extra names like /other/alias, the own one has a single slash
+        names = container.get("Names") or [""]
+        return {"Id" : container["Id"][:12],
+                "Name": next((name for name in names if name.count("/") == 1), names[0]),
+                "Image": container["Image"],
+                "Status": container["State"]}
+
+    def get_container_info(self, id, fields=None):
         container = self.get_container(id)
+        if fields:
+            return {field: lookup_field(container.attrs, field) for field in fields}
         return container.attrs
 
+    def open_logs(self, id, tail=None, since=None, until=None, follow=False, timestamps=False):
+        # Returns the chunk stream, closing it ends the request to dockerd
+        container = self.get_container(id)
+        try:
+            return container.logs(stream=True, follow=follow, tail="all" if tail is None else tail,
+                                  since=since, until=until, timestamps=timestamps)
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        except errors.DockerException as e:
+            raise ArgumentNotFound(str(e))
+
     def start_container(self, id):
         container = self.get_container(id)
         try:
@@ -107,8 +175,9 @@ class Docker():
         except errors.APIError as e:
             raise APIError(str(e.explanation))
         
-    def run_container(self, image, attr):
+    def run_container(self, image, attr, progress=None, cancelled=None):
         try:
+            self.image_manager.ensure(image, progress, cancelled)
             obj = self.client.containers.run(image, **attr.dict())
             return {"Following container sucessfully created": {
                 "Id" : obj.attrs.get('Id'), "Name": obj.attrs.get('Name')
@@ -117,11 +186,46 @@ class Docker():
         except errors.APIError as e1:
             if e1.status_code == 404:
                 raise ImageNotFound()
-            elif e1.status_code >= 409:
-                raise APIError(str(e1.explanation))
+            elif e1.status_code is not None and e1.status_code < 409:
+                # Bad parameters, e.g. a malformed port or volume spec
+                raise ArgumentNotFound(str(e1.explanation))
+            raise APIError(str(e1.explanation))
         except TypeError as e2: 
             raise ArgumentNotFound(e2.args[0])
     
+    def pull_image(self, image, progress=None, cancelled=None):
+        try:
+            self.client.api.inspect_image(image)
+            return
+        except errors.NotFound:
+            pass
+        repository, tag = parse_repository_tag(image)
+        layers = {}
+        try:
+            for event in self.client.api.pull(repository, tag=tag or "latest", stream=True, decode=True):
+                if cancelled is not None and cancelled.is_set():
+                    raise APIError("Pull of " + image + " was cancelled")
+                if "error" in event:
+                    raise APIError(event["error"])
+                detail = event.get("progressDetail") or {}
+                if event.get("id") and detail.get("total"):
+                    layers[event["id"]] = (detail.get("current", 0), detail["total"])
+                if progress is not None:
+                    progress({"status": event.get("status"),
+                              "current": sum(current for current, total in layers.values()),
+                              "total": sum(total for current, total in layers.values())})
+        except errors.NotFound:
+            raise ImageNotFound()
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+
+    def list_container_ids(self):
+        try:
+            return [(container["Id"], [name.lstrip("/") for name in container["Names"]])
+                    for container in self.client.api.containers(all=True)]
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+
     def get_container(self, id):
         try: 
             return self.client.containers.get(id)
@@ -37,3 +37,13 @@ class ResourceRunning(Exception):
     def __init__(self, message="Requested Resource is still running, please shutoff/stop resource before continue"):
         self.message = message
         super().__init__(self.message)
+
+class BackendTimeout(Exception):
+    def __init__(self, message="Backend did not answer in time -> Try again later"):
+        self.message = message
+        super().__init__(self.message)
+
+class JobLimitReached(Exception):
+    def __init__(self, message="Too many queued or running jobs -> Try again later"):
+        self.message = message
+        super().__init__(self.message)
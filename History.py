@@ -0,0 +1,262 @@
+import json
+import math
+import mmap
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import libvirt
+from docker import errors
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from Telemetry import DOMAIN_STATS, container_counters, container_sample, domain_counters, domain_sample
+
+HISTORY_ENABLED = os.getenv("HISTORY", "1") == "1"
+HISTORY_INTERVAL = float(os.getenv("HISTORY_INTERVAL", "10"))
+HISTORY_FILE = os.getenv("HISTORY_FILE", "")
+HISTORY_MAX_RESOURCES = int(os.getenv("HISTORY_MAX_RESOURCES", "1024"))
+DOCKER_CONCURRENCY = 8
+
+METRICS = ("cpuPercent", "memoryUsed", "blockReadBytesPerSec", "blockWriteBytesPerSec",
+           "netRxBytesPerSec", "netTxBytesPerSec")
+# name, step in seconds (None is the sampling interval), retention in seconds
+TIERS = (("raw", None, 3600), ("1m", 60, 6 * 3600), ("10m", 600, 24 * 3600))
+NAN = float("nan")
+
+class History():
+    def __init__(self, docker, vm, interval=HISTORY_INTERVAL, path=HISTORY_FILE, capacity=HISTORY_MAX_RESOURCES):
+        self.docker = docker
+        self.vm = vm
+        self.interval = interval
+        self.path = path
+        self.capacity = capacity
+        # Every resource owns one fixed block: per tier a ring of rows [timestamp, metric...],
+        # the row of a timestamp is (timestamp // step) % slots, so no head pointer is stored
+        self.width = 1 + len(METRICS)
+        self.tiers = []
+        offset = 0
+        for name, step, retention in TIERS:
+            step = step or interval
+            slots = int(retention // step)
+            self.tiers.append((name, step, slots, offset))
+            offset += slots * self.width
+        self.block = offset
+        self._slots = {}
+        self._updated = {}
+        self._arrays = {}
+        self._buckets = {}
+        self._previous = {}
+        self._errors = {"kvm-qemu": None, "docker": None}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._mmap = None
+        self._executor = ThreadPoolExecutor(max_workers=DOCKER_CONCURRENCY, thread_name_prefix="history-docker")
+        if path:
+            self._open()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._collect, name="history", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def record(self, key, timestamp, sample):
+        values = [NAN if sample.get(metric) is None else float(sample[metric]) for metric in METRICS]
+        with self._lock:
+            view = self._view(key)
+            self._updated[key] = timestamp
+            for name, step, slots, offset in self.tiers:
+                bucket = timestamp - timestamp % step
+                if name != "raw":
+                    # Coarse tiers hold the running mean of their bucket, rewritten on every sample
+                    start, sums, counts = self._buckets.get((key, name), (None, None, None))
+                    if start != bucket:
+                        sums, counts = [0.0] * len(METRICS), [0] * len(METRICS)
+                        self._buckets[key, name] = (bucket, sums, counts)
+                    for i, value in enumerate(values):
+                        if not math.isnan(value):
+                            sums[i] += value
+                            counts[i] += 1
+                    row = [sums[i] / counts[i] if counts[i] else NAN for i in range(len(METRICS))]
+                else:
+                    row = values
+                position = offset + int(bucket // step) % slots * self.width
+                view[position] = bucket
+                view[position + 1:position + self.width] = array("d", row)
+
+    def query(self, key, metric, start, end, step=None):
+        # Picks the coarsest tier that covers start and is not coarser than step
+        now = time.time()
+        covering = [tier for tier in self.tiers if now - tier[1] * tier[2] <= start + tier[1]] or [self.tiers[-1]]
+        fitting = [tier for tier in covering if step and tier[1] <= step]
+        name, tier_step, slots, offset = fitting[-1] if fitting else covering[0]
+        step = max(step or tier_step, tier_step)
+        column = 1 + METRICS.index(metric)
+        with self._lock:
+            if key not in self._slots:
+                return None
+            rows = self._view(key)[offset:offset + slots * self.width]
+            if numpy is not None:
+                matrix = numpy.array(rows, dtype=numpy.float64).reshape(slots, self.width)
+                timestamps, values = matrix[:, 0], matrix[:, column]
+            else:
+                timestamps, values = rows[0::self.width].tolist(), rows[column::self.width].tolist()
+        aggregate = self._aggregate if numpy is None else self._aggregate_numpy
+        return {"metric": metric, "tier": name, "step": step, **aggregate(timestamps, values, start, end, step)}
+
+    def stats(self):
+        with self._lock:
+            return {"resources": len(self._slots),
+                    "capacity": self.capacity,
+                    "file": self.path or None,
+                    "bytes": (len(self._arrays) if self._mmap is None else self.capacity) * self.block * 8,
+                    "interval": self.interval,
+                    "lastError": dict(self._errors),
+                    "tiers": [{"name": name, "step": step, "slots": slots} for name, step, slots, offset in self.tiers]}
+
+    def _aggregate(self, timestamps, values, start, end, step):
+        buckets = {}
+        for timestamp, value in zip(timestamps, values):
+            if start <= timestamp <= end and not math.isnan(value):
+                buckets.setdefault(int((timestamp - start) // step), []).append(value)
+        slots = sorted(buckets)
+        return {"timestamps": [start + slot * step for slot in slots],
+                "avg": [sum(buckets[slot]) / len(buckets[slot]) for slot in slots],
+                "min": [min(buckets[slot]) for slot in slots],
+                "max": [max(buckets[slot]) for slot in slots]}
+
+    def _aggregate_numpy(self, timestamps, values, start, end, step):
+        mask = (timestamps >= start) & (timestamps <= end) & ~numpy.isnan(values)
+        groups = ((timestamps[mask] - start) // step).astype(numpy.int64)
+        values = values[mask]
+        slots, inverse = numpy.unique(groups, return_inverse=True)
+        sums = numpy.bincount(inverse, weights=values, minlength=len(slots))
+        counts = numpy.bincount(inverse, minlength=len(slots))
+        minimum = numpy.full(len(slots), numpy.inf)
+        maximum = numpy.full(len(slots), -numpy.inf)
+        numpy.minimum.at(minimum, inverse, values)
+        numpy.maximum.at(maximum, inverse, values)
+        return {"timestamps": (start + slots * step).tolist(),
+                "avg": (sums / counts).tolist(),
+                "min": minimum.tolist(),
+                "max": maximum.tolist()}
+
+    def _view(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+        if self._mmap is None:
+            return memoryview(self._arrays[slot])
+        return memoryview(self._mmap)[slot * self.block * 8:(slot + 1) * self.block * 8].cast("d")
+
+    def _allocate(self, key):
+        # At capacity the resource updated longest ago gives up its block
+        used = set(self._slots.values())
+        free = next((slot for slot in range(self.capacity) if slot not in used), None)
+        if free is None:
+            oldest = min(self._slots, key=lambda key: self._updated.get(key, 0))
+            free = self._slots.pop(oldest)
+            self._updated.pop(oldest, None)
+            for name, step, slots, offset in self.tiers:
+                self._buckets.pop((oldest, name), None)
+        self._slots[key] = free
+        if self._mmap is None:
+            self._arrays[free] = array("d", [0.0]) * self.block
+        else:
+            view = memoryview(self._mmap)[free * self.block * 8:(free + 1) * self.block * 8]
+            view[:] = bytes(len(view))
+            self._save_index()
+        return free
+
+    def _open(self):
+        # The spill file is a plain array of blocks, the sidecar maps resources to blocks
+        layout = {"interval": self.interval, "metrics": list(METRICS), "capacity": self.capacity,
+                  "tiers": [[name, step, slots] for name, step, slots, offset in self.tiers]}
+        index = {}
+        try:
+            with open(self.path + ".json") as file:
+                saved = json.load(file)
+            if saved.get("layout") == layout:
+                index = saved["slots"]
+        except (OSError, ValueError):
+            pass
+        size = self.capacity * self.block * 8
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not index or os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                index = {}
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._layout = layout
+        self._slots = {tuple(key.split("/", 1)): slot for key, slot in index.items()}
+
+    def _save_index(self):
+        temporary = self.path + ".json.tmp"
+        with open(temporary, "w") as file:
+            json.dump({"layout": self._layout,
+                       "slots": {backend + "/" + key: slot for (backend, key), slot in self._slots.items()}}, file)
+        os.replace(temporary, self.path + ".json")
+
+    def _collect(self):
+        while self._running:
+            begin = time.monotonic()
+            # Any error only skips the round of its backend, the thread has to outlive outages
+            for backend, collect in (("kvm-qemu", self._collect_domains), ("docker", self._collect_containers)):
+                try:
+                    collect()
+                    self._errors[backend] = None
+                except Exception as e:
+                    self._errors[backend] = getattr(e, "message", str(e))
+            time.sleep(max(0.0, self.interval - (time.monotonic() - begin)))
+
+    def _collect_domains(self):
+        # One bulk call for all running domains per interval
+        with self.vm.libvirt_connect() as conn:
+            records = conn.getAllDomainStats(DOMAIN_STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        now = time.time()
+        self._forget("kvm-qemu", {dom.UUIDString() for dom, record in records})
+        for dom, record in records:
+            key = ("kvm-qemu", dom.UUIDString())
+            counters = domain_counters(record)
+            last, before = self._previous.get(key, (None, None))
+            self.record(key, now, domain_sample(key[1], record, counters, before, now - last if last else 0))
+            self._previous[key] = (now, counters)
+
+    def _collect_containers(self):
+        # Docker has no bulk stats call, one_shot skips the second sample dockerd takes for
+        # precpu_stats, the previous collection round provides those instead
+        ids = [container["Id"] for container in
+               self.docker.client.api.containers(filters={"status": "running"})]
+        self._forget("docker", set(ids))
+        for id, stats in zip(ids, self._executor.map(self._container_stats, ids)):
+            if stats is None:
+                continue
+            now = time.time()
+            key = ("docker", id)
+            counters = container_counters(stats)
+            last, before, cpu_stats = self._previous.get(key, (None, None, stats.get("cpu_stats") or {}))
+            self.record(key, now, container_sample(id, dict(stats, precpu_stats=cpu_stats), counters, before,
+                                                   now - last if last else 0))
+            self._previous[key] = (now, counters, stats.get("cpu_stats") or {})
+
+    def _forget(self, backend, keys):
+        # Counters of stopped resources are dropped, their rates restart from scratch
+        for key in [key for key in self._previous if key[0] == backend and key[1] not in keys]:
+            del self._previous[key]
+
+    def _container_stats(self, id):
+        try:
+            return self.docker.client.api.stats(id, stream=False, one_shot=True)
+        except errors.APIError:
+            return None
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import time
+from Backend import AsyncBackend, DOCKER_WORKERS, LIBVIRT_WORKERS
+from Connection import POOL_SIZE
+from Docker import Docker
+from Exceptions import ResourceNotFound
+from Metrics import instrument
+from Routing import ResourceIndex
+from VM import VM
+
+HOSTS_FILE = os.getenv("HOSTS", "")
+HOST_TIMEOUT = float(os.getenv("HOST_TIMEOUT", "5"))
+LOCAL_HOST = os.getenv("LOCAL_HOST", "local")
+HOST_SEPARATOR = ":"
+
+def load_config(path=HOSTS_FILE):
+    # {"node2": {"docker": "tcp://node2:2376", "libvirt": "qemu+ssh://node2/system"}}
+    if not path:
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+class Host():
+    def __init__(self, name, docker, vm, index=None, config=None):
+        self.name = name
+        self.docker = docker
+        self.vm = vm
+        self.index = index or ResourceIndex(docker, vm)
+        self.config = config or {}
+
+    def to_dict(self):
+        return {"name": self.name,
+                "docker": self.config.get("docker"),
+                "libvirt": self.config.get("libvirt"),
+                "backends": [self.docker.stats(), self.vm.stats()]}
+
+class HostRegistry():
+    def __init__(self, local, config=None, timeout=HOST_TIMEOUT):
+        self.local = local
+        self.timeout = timeout
+        self.hosts = {local.name: local}
+        config = load_config() if config is None else config
+        for name, spec in config.items():
+            if name in self.hosts or HOST_SEPARATOR in name:
+                raise ValueError("Invalid or duplicate host name " + name)
+            self.hosts[name] = self.connect(name, spec)
+
+    def connect(self, name, spec):
+        # Every host gets its own executors and libvirt connection pool, a hanging
+        # daemon can only exhaust the workers of its own host
+        docker = AsyncBackend(instrument(Docker(spec["docker"], spec.get("docker_version")), "docker@" + name),
+                              "docker@" + name, spec.get("docker_workers", DOCKER_WORKERS))
+        vm = AsyncBackend(instrument(VM(spec["libvirt"], spec.get("pool_size", POOL_SIZE)), "kvm-qemu@" + name),
+                          "kvm-qemu@" + name, spec.get("libvirt_workers", LIBVIRT_WORKERS))
+        return Host(name, docker, vm, config=spec)
+
+    def get(self, name):
+        return self.hosts.get(name)
+
+    def select(self, names=None):
+        if not names:
+            return list(self.hosts.values())
+        unknown = [name for name in names if name not in self.hosts]
+        if unknown:
+            raise ResourceNotFound("Unknown host " + ", ".join(unknown))
+        return [self.hosts[name] for name in names]
+
+    def split(self, id):
+        # "node2:web" addresses web on node2, ids without a known host prefix are local
+        name, separator, key = id.partition(HOST_SEPARATOR)
+        if separator and name in self.hosts:
+            return self.hosts[name], key
+        return None, id
+
+    def qualify(self, host, key):
+        return host.name + HOST_SEPARATOR + key
+
+    async def resolve(self, id):
+        host, key = self.split(id)
+        if host is not None:
+            return (host, *await host.index.resolve(key))
+        try:
+            return (self.local, *await self.local.index.resolve(key))
+        except ResourceNotFound:
+            if len(self.hosts) == 1:
+                raise
+        # Unqualified ids unknown locally are looked up everywhere, the first host that knows them wins
+        remote = [host for host in self.hosts.values() if host is not self.local]
+        pending = {asyncio.ensure_future(asyncio.wait_for(host.index.resolve(key), self.timeout)): host
+                   for host in remote}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    host = pending.pop(task)
+                    if not task.cancelled() and task.exception() is None:
+                        return (host, *task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+        raise ResourceNotFound()
+
+    async def fan_out(self, hosts, call):
+        # Yields (host, result, report) as hosts answer, a slow host only delays itself
+        async def run(host):
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(call(host), self.timeout)
+                report = {"status": "ok"}
+            except asyncio.TimeoutError:
+                result = None
+                report = {"status": "timeout", "detail": "No answer within " + str(self.timeout) + "s"}
+            except Exception as e:
+                result = None
+                report = {"status": "error", "detail": getattr(e, "message", str(e))}
+            report["elapsed"] = time.monotonic() - start
+            return host, result, report
+
+        for task in asyncio.as_completed([run(host) for host in hosts]):
+            yield await task
@@ -0,0 +1,192 @@
+import os
+import queue
+import threading
+import time
+from docker import errors
+from docker.utils import parse_repository_tag
+from Exceptions import APIError
+
+IMAGE_WARM_LIST = [image.strip() for image in os.getenv("IMAGE_WARM_LIST", "").split(",") if image.strip()]
+IMAGE_DISK_BUDGET = int(os.getenv("IMAGE_DISK_BUDGET", "0"))
+PULL_POLL_INTERVAL = 0.5
+
+def normalize(image):
+    if "@" in image:
+        return image
+    repository, tag = parse_repository_tag(image)
+    return repository + ":" + (tag or "latest")
+
+class Pull():
+    def __init__(self, reference):
+        self.reference = reference
+        self.done = threading.Event()
+        self.error = None
+        self.progress = None
+        self.callbacks = []
+
+class ImageManager():
+    def __init__(self, docker, warm_list=IMAGE_WARM_LIST, budget=IMAGE_DISK_BUDGET):
+        self.docker = docker
+        self.warm_list = warm_list
+        self.budget = budget
+        self._pulls = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._counters = {"pulls": 0, "joined": 0, "cached": 0, "evicted": 0}
+
+    def ensure(self, image, progress=None, cancelled=None):
+        pull = self.pull(image)
+        if pull is not None:
+            if progress is not None:
+                self.subscribe(pull, progress)
+            # The pull runs on its own thread, a cancelled caller only stops waiting
+            while not pull.done.wait(PULL_POLL_INTERVAL):
+                if cancelled is not None and cancelled.is_set():
+                    raise APIError("Pull of " + image + " was cancelled")
+            if pull.error is not None:
+                raise pull.error
+        self.touch(image)
+
+    def pull(self, image):
+        # Returns the pull in progress for the image, starting one if needed,
+        # or None if the image is already present
+        reference = normalize(image)
+        with self._lock:
+            pull = self._pulls.get(reference)
+            if pull is not None:
+                self._counters["joined"] += 1
+                return pull
+        if self.inspect(reference) is not None:
+            with self._lock:
+                self._counters["cached"] += 1
+            return None
+        with self._lock:
+            pull = self._pulls.get(reference)
+            if pull is not None:
+                self._counters["joined"] += 1
+                return pull
+            pull = self._pulls[reference] = Pull(reference)
+            self._counters["pulls"] += 1
+        threading.Thread(target=self._run, args=(pull,), name="pull-" + reference, daemon=True).start()
+        return pull
+
+    def follow(self, image):
+        # Yields the progress of the image's pull until it finished
+        reference = normalize(image)
+        pull = self.pull(reference)
+        if pull is None:
+            self.touch(reference)
+            yield {"status": "Image is up to date", "image": reference}
+            return
+        updates = queue.Queue()
+        self.subscribe(pull, updates.put)
+        while True:
+            try:
+                yield updates.get(timeout=PULL_POLL_INTERVAL)
+            except queue.Empty:
+                if pull.done.is_set() and updates.empty():
+                    break
+        if pull.error is not None:
+            raise pull.error
+        yield {"status": "Downloaded", "image": reference}
+
+    def subscribe(self, pull, callback):
+        with self._lock:
+            pull.callbacks.append(callback)
+            progress = pull.progress
+        if progress is not None:
+            callback(progress)
+
+    def warm(self):
+        for image in self.warm_list:
+            try:
+                self.pull(image)
+            except (APIError, errors.APIError):
+                pass
+
+    def touch(self, image):
+        attrs = self.inspect(normalize(image))
+        if attrs is not None:
+            self._last_used[attrs["Id"]] = time.time()
+
+    def inspect(self, reference):
+        try:
+            return self.docker.client.api.inspect_image(reference)
+        except errors.NotFound:
+            return None
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+
+    def evict(self):
+        # Removes the least recently used images nobody runs until the budget fits
+        if not self.budget:
+            return []
+        try:
+            images = self.docker.client.api.images()
+            used = sum(image.get("Size", 0) for image in images)
+            if used <= self.budget:
+                return []
+            in_use = {container.get("ImageID") for container in self.docker.client.api.containers(all=True)}
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        pinned = {normalize(image) for image in self.warm_list}
+        candidates = [image for image in images
+                      if image["Id"] not in in_use and not pinned & set(image.get("RepoTags") or [])]
+        candidates.sort(key=lambda image: self._last_used.get(image["Id"], image.get("Created", 0)))
+        removed = []
+        for image in candidates:
+            if used <= self.budget:
+                break
+            try:
+                self.docker.client.api.remove_image(image["Id"])
+            except errors.APIError:
+                continue
+            used -= image.get("Size", 0)
+            self._last_used.pop(image["Id"], None)
+            removed.append(image["Id"])
+        with self._lock:
+            self._counters["evicted"] += len(removed)
+        return removed
+
+    def stats(self):
+        try:
+            images = self.docker.client.api.images()
+        except errors.APIError as e:
+            raise APIError(str(e.explanation))
+        with self._lock:
+            pulling = {reference: pull.progress for reference, pull in self._pulls.items()}
+            counters = dict(self._counters)
+        return {"budget": self.budget or None,
+                "used": sum(image.get("Size", 0) for image in images),
+                "warmList": self.warm_list,
+                "pulling": pulling,
+                **counters,
+                "images": [{"Id": image["Id"],
+                            "Name": (image.get("RepoTags") or ["<none>:<none>"])[0],
+                            "Size": image.get("Size"),
+                            "lastUsed": self._last_used.get(image["Id"])}
+                           for image in images]}
+
+    def _run(self, pull):
+        try:
+            self.docker.pull_image(pull.reference, lambda progress: self._publish(pull, progress))
+        except Exception as e:
+            pull.error = e
+        finally:
+            with self._lock:
+                self._pulls.pop(pull.reference, None)
+            pull.done.set()
+        if pull.error is None:
+            try:
+                self.touch(pull.reference)
+                self.evict()
+            except APIError:
+                pass
+
+    def _publish(self, pull, progress):
+        progress = dict(progress, image=pull.reference)
+        with self._lock:
+            pull.progress = progress
+            callbacks = list(pull.callbacks)
+        for callback in callbacks:
+            callback(progress)
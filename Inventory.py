@@ -0,0 +1,303 @@
+import collections
+import os
+import queue
+import threading
+import time
+import uuid
+import libvirt
+from libvirt import libvirtError
+from Exceptions import ResourceNotFound
+from Routing import SHORT_ID_LENGTH
+from VM import STORAGE_CACHE_TTL
+
+INVENTORY_ENABLED = os.getenv("INVENTORY", "1") == "1"
+RECONNECT_DELAY = 5.0
+INVENTORY_CHANGELOG = int(os.getenv("INVENTORY_CHANGELOG", "10000"))
+
+KINDS = {
+    "containers": "docker",
+    "images": "docker",
+    "domains": "kvm-qemu",
+    "volumes": "kvm-qemu"
+}
+# Volumes created by other libvirt clients raise no event, their model expires like the storage cache
+MAX_AGE = {"volumes": STORAGE_CACHE_TTL}
+
+class Inventory():
+    def __init__(self, docker, vm):
+        self.docker = docker
+        self.vm = vm
+        self.generation = 0
+        # Versions handed to clients carry the epoch, generations of an earlier process never match
+        self.epoch = uuid.uuid4().hex[:8]
+        self.listeners = []
+        self._changes = collections.deque(maxlen=INVENTORY_CHANGELOG)
+        self._horizon = 0
+        self._models = {kind: {} for kind in KINDS}
+        self._stale = {kind: True for kind in KINDS}
+        self._synced = {kind: 0.0 for kind in KINDS}
+        self._connected = {"docker": False, "kvm-qemu": False}
+        self._last_sync = {"docker": None, "kvm-qemu": None}
+        self._last_update = time.monotonic()
+        self._lock = threading.RLock()
+        self._events = queue.Queue()
+        self._running = False
+        self._docker_events = None
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._watch_docker, name="inventory-docker", daemon=True),
+                         threading.Thread(target=self._watch_libvirt, name="inventory-libvirt", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._docker_events is not None:
+            self._docker_events.close()
+
+    def list(self, kind):
+        # None tells the caller to ask the backend, the model is not trustworthy
+        with self._lock:
+            if not self._servable(kind):
+                return None
+            return list(self._models[kind].values())
+
+    def snapshot(self, kind):
+        # Rows together with the version they belong to, None like list()
+        with self._lock:
+            if not self._servable(kind):
+                return None
+            return self.version(), list(self._models[kind].values())
+
+    def version(self):
+        return self.epoch + "." + str(self.generation)
+
+    def parse_version(self, version):
+        epoch, _, generation = version.partition(".")
+        if epoch != self.epoch or not generation.isdigit():
+            return None
+        return int(generation)
+
+    def changes(self, kind, since):
+        # {key: (first change after since, current row or None)}, None if the
+        # change log no longer reaches back to since
+        with self._lock:
+            if not self._servable(kind):
+                return None
+            if since < self._horizon or since > self.generation:
+                return None
+            touched = {}
+            for generation, change_kind, key, change in self._changes:
+                if generation > since and change_kind == kind:
+                    touched.setdefault(key, change)
+            model = self._models[kind]
+            return self.version(), {key: (change, model.get(key)) for key, change in touched.items()}
+
+    def invalidate(self, kind):
+        with self._lock:
+            self._stale[kind] = True
+        if self._running:
+            threading.Thread(target=self._resync_quietly, args=(kind,), daemon=True).start()
+
+    def _servable(self, kind):
+        # Called with the lock held, an expired model is resynced in the background
+        if not self._connected[KINDS[kind]] or self._stale[kind]:
+            return False
+        if kind in MAX_AGE and time.monotonic() - self._synced[kind] > MAX_AGE[kind]:
+            self.invalidate(kind)
+            return False
+        return True
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {"generation": self.generation,
+                    "version": self.version(),
+                    "changelog": len(self._changes),
+                    "age": now - self._last_update,
+                    "sources": {source: {"connected": self._connected[source],
+                                         "sinceSync": now - self._last_sync[source]
+                                                      if self._last_sync[source] else None}
+                                for source in self._connected},
+                    "stale": [kind for kind, stale in self._stale.items() if stale],
+                    "counts": {kind: len(model) for kind, model in self._models.items()}}
+
+    def resync(self, kind):
+        if kind == "containers":
+            rows = {row["Id"]: row for row in self.docker.list_containers()}
+        elif kind == "images":
+            rows = {row["Id"]: row for row in self.docker.list_images()}
+        elif kind == "domains":
+            rows = {row["uuid"]: row for row in self.vm.list_vms()}
+        else:
+            # A resync has to see the pools as they are, not the storage cache
+            self.vm.invalidate_storage()
+            rows = {row["path"]: row for row in self.vm.list_storage_vol()}
+        with self._lock:
+            old = self._models[kind]
+            self._models[kind] = rows
+            self._stale[kind] = False
+            self._synced[kind] = time.monotonic()
+            changed = [(key, row) for key, row in rows.items() if old.get(key) != row]
+            removed = [key for key in old if key not in rows]
+            if changed or removed:
+                self._bump()
+                for key, row in changed:
+                    self._log(kind, key, "changed" if key in old else "added")
+                for key in removed:
+                    self._log(kind, key, "removed")
+        for key, row in changed:
+            self._notify(kind, key, row)
+        for key in removed:
+            self._notify(kind, key, None)
+
+    def _resync_quietly(self, kind):
+        try:
+            self.resync(kind)
+        except Exception:
+            pass
+
+    def update(self, kind, key, row):
+        with self._lock:
+            model = self._models[kind]
+            if row is None:
+                if model.pop(key, None) is None:
+                    return
+                change = "removed"
+            elif model.get(key) == row:
+                return
+            else:
+                change = "changed" if key in model else "added"
+                model[key] = row
+            self._bump()
+            self._log(kind, key, change)
+        self._notify(kind, key, row)
+
+    def _bump(self):
+        self.generation += 1
+        self._last_update = time.monotonic()
+
+    def _log(self, kind, key, change):
+        if len(self._changes) == self._changes.maxlen:
+            self._horizon = self._changes[0][0]
+        self._changes.append((self.generation, kind, key, change))
+
+    def _notify(self, kind, key, row):
+        for listener in self.listeners:
+            try:
+                listener(kind, key, row)
+            except Exception:
+                pass
+
+    def _set_connected(self, source, connected):
+        with self._lock:
+            self._connected[source] = connected
+            if connected:
+                self._last_sync[source] = time.monotonic()
+            else:
+                for kind, owner in KINDS.items():
+                    if owner == source:
+                        self._stale[kind] = True
+
+    def _watch_docker(self):
+        while self._running:
+            try:
+                # Subscribe before the full sync so no event in between gets lost
+                self._docker_events = self.docker.client.events(decode=True)
+                self.resync("containers")
+                self.resync("images")
+                self._set_connected("docker", True)
+                for event in self._docker_events:
+                    self._handle_docker_event(event)
+            except Exception:
+                pass
+            self._set_connected("docker", False)
+            if self._running:
+                time.sleep(RECONNECT_DELAY)
+
+    def _handle_docker_event(self, event):
+        type = event.get("Type")
+        action = event.get("Action") or ""
+        if type == "container":
+            if action.startswith("exec_") or action.startswith("health_status"):
+                return
+            id = event.get("Actor", {}).get("ID") or event.get("id")
+            key = id[:SHORT_ID_LENGTH]
+            if action == "destroy":
+                self.update("containers", key, None)
+                return
+            try:
+                self.update("containers", key, self.docker.get_container_summary(id))
+            except ResourceNotFound:
+                self.update("containers", key, None)
+        elif type == "image":
+            self.resync("images")
+
+    def _watch_libvirt(self):
+        while self._running:
+            conn = None
+            callbacks = []
+            closed = threading.Event()
+            try:
+                conn = libvirt.open(self.vm.pool.uri)
+                conn.registerCloseCallback(lambda *args: closed.set(), None)
+                callbacks.append(("domain", conn.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_domain_event, None)))
+                for event_id in (libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE,
+                                 libvirt.VIR_STORAGE_POOL_EVENT_ID_REFRESH):
+                    callbacks.append(("pool", conn.storagePoolEventRegisterAny(
+                        None, event_id, self._on_pool_event, None)))
+                self.resync("domains")
+                self.resync("volumes")
+                self._set_connected("kvm-qemu", True)
+                while self._running and not closed.is_set():
+                    try:
+                        kind, key, event = self._events.get(timeout=1)
+                    except queue.Empty:
+                        if conn.isAlive() != 1:
+                            break
+                        continue
+                    self._handle_libvirt_event(kind, key, event)
+            except Exception:
+                pass
+            self._set_connected("kvm-qemu", False)
+            if conn is not None:
+                self._close_libvirt(conn, callbacks)
+            if self._running:
+                time.sleep(RECONNECT_DELAY)
+
+    def _close_libvirt(self, conn, callbacks):
+        try:
+            for type, callback_id in callbacks:
+                if type == "domain":
+                    conn.domainEventDeregisterAny(callback_id)
+                else:
+                    conn.storagePoolEventDeregisterAny(callback_id)
+            conn.unregisterCloseCallback()
+            conn.close()
+        except libvirtError:
+            pass
+
+    # Called from the libvirt event loop thread, which must never block on RPCs
+    def _on_domain_event(self, conn, dom, event, detail, opaque):
+        self._events.put(("domains", dom.UUIDString(), event))
+
+    def _on_pool_event(self, conn, pool, *args):
+        self._events.put(("volumes", pool.name(), None))
+
+    def _handle_libvirt_event(self, kind, key, event):
+        if kind == "volumes":
+            self.vm.invalidate_storage(key)
+            self.resync("volumes")
+        elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.vm.forget_snapshots(key)
+            self.update("domains", key, None)
+        else:
+            # Reverts and snapshot defines arrive as lifecycle events
+            self.vm.invalidate_snapshots(key)
+            try:
+                self.update("domains", key, self.vm.get_vm_summary(key))
+            except ResourceNotFound:
+                self.update("domains", key, None)
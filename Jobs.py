@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from Exceptions import JobLimitReached
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_STORE_SIZE = int(os.getenv("JOB_STORE_SIZE", "1000"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "3600"))
+JOB_MAX_ACTIVE = int(os.getenv("JOB_MAX_ACTIVE", "500"))
+SUBSCRIBER_BUFFER = 100
+
+FINISHED = ("succeeded", "failed", "cancelled")
+
+class Job():
+    def __init__(self, type, target, cancel=None):
+        self.id = uuid.uuid4().hex
+        self.type = type
+        self.target = target
+        self.status = "queued"
+        self.progress = None
+        self.result = None
+        self.detail = None
+        self.status_code = None
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+        self.cancel = cancel
+        self.cancel_requested = False
+        self.done = asyncio.Event()
+        self.task = None
+        self._finished_at = None
+
+    def to_dict(self):
+        return {"id": self.id,
+                "type": self.type,
+                "target": self.target,
+                "status": self.status,
+                "progress": self.progress,
+                "result": self.result,
+                "detail": self.detail,
+                "statusCode": self.status_code,
+                "cancellable": self.status == "queued" or
+                               (self.status == "running" and self.cancel is not None),
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished}
+
+class JobManager():
+    def __init__(self, error_status, workers=JOB_WORKERS, size=JOB_STORE_SIZE, ttl=JOB_TTL,
+                 max_active=JOB_MAX_ACTIVE):
+        self.error_status = error_status
+        self.size = size
+        self.ttl = ttl
+        # Only finished jobs can be evicted, the active ones are capped below the store size
+        self.max_active = min(max_active, size)
+        self._active = 0
+        self.jobs = OrderedDict()
+        self._workers = asyncio.Semaphore(workers)
+        self._subscribers = set()
+
+    def submit(self, type, target, func, cancel=None):
+        # func is a coroutine function receiving the job, so it can report progress
+        self._evict()
+        if self._active >= self.max_active:
+            raise JobLimitReached()
+        job = Job(type, target, cancel)
+        self.jobs[job.id] = job
+        self._active += 1
+        job.task = asyncio.ensure_future(self._run(job, func))
+        # A task cancelled before its first step never enters _run, the callback still fires
+        job.task.add_done_callback(lambda task: self._release(job))
+        self._publish(job)
+        return job
+
+    def get(self, id):
+        self._evict()
+        return self.jobs.get(id)
+
+    def list(self):
+        self._evict()
+        return [job.to_dict() for job in reversed(self.jobs.values())]
+
+    async def wait(self, job, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(job.done.wait()), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job
+
+    async def cancel(self, job):
+        if job.status == "queued":
+            job.task.cancel()
+            return True
+        if job.status == "running" and job.cancel is not None:
+            job.cancel_requested = True
+            await job.cancel()
+            return True
+        return False
+
+    async def events(self):
+        queue = asyncio.Queue(SUBSCRIBER_BUFFER)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                yield "event: " + job["status"] + "\ndata: " + json.dumps(job, default=str) + "\n\n"
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _run(self, job, func):
+        try:
+            async with self._workers:
+                job.status = "running"
+                job.started = datetime.now()
+                self._publish(job)
+                job.result = await func(job)
+                job.status = "succeeded"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "cancelled" if job.cancel_requested else "failed"
+            job.detail = getattr(e, "message", str(e))
+            job.status_code = self.error_status.get(type(e), 500)
+        finally:
+            job.finished = datetime.now()
+            job._finished_at = time.monotonic()
+            job.done.set()
+            self._publish(job)
+
+    def _release(self, job):
+        self._active -= 1
+        if not job.done.is_set():
+            job.status = "cancelled"
+            job.finished = datetime.now()
+            job._finished_at = time.monotonic()
+            job.done.set()
+            self._publish(job)
+
+    def _publish(self, job):
+        # Slow feed readers are dropped rather than buffering without limit
+        state = job.to_dict()
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(state)
+            except asyncio.QueueFull:
+                self._subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _evict(self):
+        now = time.monotonic()
+        for id, job in list(self.jobs.items()):
+            if job._finished_at is not None and now - job._finished_at > self.ttl:
+                del self.jobs[id]
+        if len(self.jobs) >= self.size:
+            for id, job in list(self.jobs.items()):
+                if len(self.jobs) < self.size:
+                    break
+                if job.status in FINISHED:
+                    del self.jobs[id]
@@ -0,0 +1,143 @@
+import base64
+import bisect
+import hashlib
+import json
+from Exceptions import ArgumentNotFound
+
+RESOURCE_TYPES = {
+    "docker container": "containers",
+    "container": "containers",
+    "containers": "containers",
+    "docker images": "images",
+    "image": "images",
+    "images": "images",
+    "kvm-qemu vms": "domains",
+    "vm": "domains",
+    "vms": "domains",
+    "kvm-qemu volumes": "volumes",
+    "volume": "volumes",
+    "volumes": "volumes"
+}
+
+DEFAULT_PAGE_SIZE = 100
+
+KEY_FIELDS = {"containers": "Id", "images": "Id", "domains": "uuid", "volumes": "path"}
+NAME_FIELDS = {"containers": "Name", "images": "Name", "domains": "name", "volumes": "name"}
+STATUS_FIELDS = {"containers": "Status", "domains": "status"}
+SUMMARY_FIELDS = {
+    "containers": {"Id", "Name", "Image", "Status"},
+    "images": {"Name", "Id", "Created"}
+}
+
+def parse_type(type):
+    kind = RESOURCE_TYPES.get(type.strip().lower())
+    if kind is None:
+        raise ArgumentNotFound("Unknown resource type " + type)
+    return kind
+
+def parse_fields(fields):
+    if not fields:
+        return []
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ArgumentNotFound("Invalid cursor " + cursor)
+
+def matches(kind, row, status=None, name=None, image=None, persistent=None):
+    if status is not None:
+        if kind not in STATUS_FIELDS or str(row.get(STATUS_FIELDS[kind])).lower() != status.lower():
+            return False
+    if name is not None and not str(row.get(NAME_FIELDS[kind], "")).lstrip("/").startswith(name):
+        return False
+    if image is not None and not str(row.get("Image", "")).startswith(image):
+        return False
+    if persistent is not None and bool(row.get("isPersistent")) != persistent:
+        return False
+    return True
+
+def lookup_field(attrs, path):
+    value = attrs
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def project(row, fields):
+    if not fields:
+        return row
+    return {field: row.get(field) for field in fields}
+
+async def filter_rows(kind, rows, **filters):
+    async for row in rows:
+        if matches(kind, row, **filters):
+            yield row
+
+async def paginate(kind, rows, page_size, cursor=None):
+    # Keeps only page_size + 1 rows at a time, the extra row tells whether a next page exists
+    key_field = KEY_FIELDS[kind]
+    after = decode_cursor(cursor) if cursor else None
+    page = []
+    async for row in rows:
+        key = str(row.get(key_field))
+        if after is not None and key <= after:
+            continue
+        if len(page) > page_size and key >= page[-1][0]:
+            continue
+        bisect.insort(page, (key, row), key=lambda entry: entry[0])
+        del page[page_size + 1:]
+    if len(page) > page_size:
+        return [row for key, row in page[:page_size]], encode_cursor(page[page_size - 1][0])
+    return [row for key, row in page], None
+
+async def iterate(rows):
+    for row in rows:
+        yield row
+
+async def peek(rows):
+    rows = aiter(rows)
+    try:
+        first = await anext(rows)
+    except StopAsyncIteration:
+        return iterate([])
+
+    async def chained():
+        yield first
+        async for row in rows:
+            yield row
+    return chained()
+
+async def to_ndjson(rows, fields):
+    async for row in rows:
+        yield json.dumps(project(row, fields), default=str) + "\n"
+
+def digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def make_etag(version, query):
+    # Inventory version plus the query, no listing has to be built to compare it
+    return '"' + version + "-" + digest(query) + '"'
+
+def content_etag(rows):
+    return '"' + digest(rows) + '"'
+
+def etag_matches(header, etag):
+    # If-None-Match compares weakly
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+def delta_rows(kind, changes, fields, **filters):
+    # Rows leaving the filter count as removed, rows added and dropped again are left out
+    added, changed, removed = [], [], []
+    for key, (change, row) in changes.items():
+        if row is not None and matches(kind, row, **filters):
+            (added if change == "added" else changed).append(project(row, fields))
+        elif change != "added":
+            removed.append(key)
+    return {"added": added, "changed": changed, "removed": removed}
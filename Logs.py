@@ -0,0 +1,224 @@
+import asyncio
+import os
+import threading
+from libvirt import libvirtError
+from Exceptions import ArgumentNotFound
+
+LOG_FOLLOWER_BUFFER = int(os.getenv("LOG_FOLLOWER_BUFFER", "256"))
+LOG_READ_TIMEOUT = float(os.getenv("LOG_READ_TIMEOUT", "300"))
+CONSOLE_CHUNK = 4096
+
+class Upstream():
+    def __init__(self, key):
+        self.key = key
+        self.followers = set()
+        self.joining = 0
+        self.ready = None
+        self.close = None
+        self.closed = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+class LogStreams():
+    def __init__(self, docker, vm):
+        self.docker = docker
+        self.vm = vm
+        self.dropped = 0
+        self._upstreams = {}
+        self._loop = None
+
+    async def open(self, backend, key, tail=None, since=None, until=None, follow=False, timestamps=False):
+        # Returns an async iterator of chunks, backend errors surface before the first byte
+        if backend == "kvm-qemu":
+            if not follow or tail is not None or since is not None or until is not None or timestamps:
+                raise ArgumentNotFound("kvm-qemu consoles are live only, use follow=true without "
+                                       "tail, since, until or timestamps")
+            upstream, queue = await self._join(("kvm-qemu", key), lambda: self._open_console(key))
+            return self._follow(upstream, queue)
+        if not follow or until is not None:
+            # Reads that end on their own are not shared, a slow client holds back dockerd
+            stream = await self.docker.run(self.docker.backend.open_logs, key, tail, since, until, follow,
+                                           timestamps)
+            return self._bounded(stream)
+        upstream, queue = await self._join(("docker", key, timestamps),
+                                           lambda: self._open_container(key, timestamps))
+        if tail == 0:
+            return self._follow(upstream, queue)
+        # Subscribed before the history is read, lines logged in between can repeat but not go missing
+        try:
+            stream = await self.docker.run(self.docker.backend.open_logs, key, tail, since, None, False,
+                                           timestamps)
+        except Exception:
+            self._leave(upstream, queue)
+            raise
+        return self._follow(upstream, queue, self.docker.stream(iter, stream))
+
+    def stop(self):
+        for upstream in list(self._upstreams.values()):
+            self._close(upstream)
+
+    def stats(self):
+        return {"upstreams": [{"backend": upstream.key[0], "id": upstream.key[1],
+                               "followers": len(upstream.followers)}
+                              for upstream in self._upstreams.values()],
+                "dropped": self.dropped}
+
+    async def _join(self, key, open_upstream):
+        # All followers of a container or console share one stream from the backend
+        self._loop = asyncio.get_running_loop()
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            upstream = self._upstreams[key] = Upstream(key)
+            upstream.ready = asyncio.ensure_future(self._start(upstream, open_upstream))
+        upstream.joining += 1
+        try:
+            await asyncio.shield(upstream.ready)
+        except asyncio.CancelledError:
+            upstream.joining -= 1
+            self._leave(upstream, None)
+            raise
+        except Exception:
+            upstream.joining -= 1
+            raise
+        upstream.joining -= 1
+        queue = asyncio.Queue(LOG_FOLLOWER_BUFFER)
+        if upstream.finished:
+            queue.put_nowait(None)
+        else:
+            upstream.followers.add(queue)
+        return upstream, queue
+
+    async def _start(self, upstream, open_upstream):
+        try:
+            chunks, upstream.close = await open_upstream()
+        except Exception:
+            self._upstreams.pop(upstream.key, None)
+            raise
+        if self._upstreams.get(upstream.key) is not upstream:
+            # Every follower left while the stream was being opened
+            threading.Thread(target=self._close, args=(upstream,), daemon=True).start()
+            return
+        threading.Thread(target=self._pump, args=(upstream, chunks), name="logs-" + upstream.key[1][:12],
+                         daemon=True).start()
+
+    async def _open_container(self, key, timestamps):
+        stream = await self.docker.run(self.docker.backend.open_logs, key, 0, None, None, True, timestamps)
+        return stream, stream.close
+
+    async def _open_console(self, key):
+        conn, stream = await self.vm.run(self.vm.backend.open_console, key)
+
+        def chunks():
+            while True:
+                data = stream.recv(CONSOLE_CHUNK)
+                if not data:
+                    return
+                yield data
+
+        def close():
+            try:
+                stream.abort()
+            except libvirtError:
+                pass
+            try:
+                conn.close()
+            except libvirtError:
+                pass
+        return chunks(), close
+
+    async def _bounded(self, stream):
+        # Unshared reads run on a stream thread of their own and end after LOG_READ_TIMEOUT
+        # seconds, a far away until or a stalled client cannot keep the read open forever
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            stream.close()
+
+        deadline = threading.Timer(LOG_READ_TIMEOUT, expire)
+        deadline.daemon = True
+        deadline.start()
+        try:
+            async for chunk in self.docker.stream(iter, stream):
+                yield chunk
+        except Exception:
+            # Closing the stream underneath the read surfaces as whatever the transport raises
+            if not expired.is_set():
+                raise
+        finally:
+            deadline.cancel()
+            # A reader that left early would leave the producer blocked on the next chunk
+            if not expired.is_set():
+                threading.Thread(target=stream.close, daemon=True).start()
+
+    async def _follow(self, upstream, queue, history=None):
+        try:
+            if history is not None:
+                async for chunk in history:
+                    yield chunk
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self._leave(upstream, queue)
+            if history is not None:
+                await history.aclose()
+
+    def _pump(self, upstream, chunks):
+        try:
+            for chunk in chunks:
+                self._call(self._deliver, upstream, chunk)
+        except Exception:
+            # Closing the stream underneath the read surfaces as whatever the transport raises
+            pass
+        finally:
+            self._close(upstream)
+            self._call(self._finish, upstream)
+
+    def _close(self, upstream):
+        with upstream.lock:
+            if upstream.closed or upstream.close is None:
+                return
+            upstream.closed = True
+        upstream.close()
+
+    def _call(self, func, *args):
+        try:
+            self._loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            pass
+
+    def _deliver(self, upstream, chunk):
+        # Runs on the event loop, a follower whose buffer is full is dropped so
+        # neither the upstream nor the other followers wait for it
+        for queue in list(upstream.followers):
+            try:
+                queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                self._leave(upstream, queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _finish(self, upstream):
+        upstream.finished = True
+        if self._upstreams.get(upstream.key) is upstream:
+            del self._upstreams[upstream.key]
+        for queue in upstream.followers:
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                queue.get_nowait()
+                queue.put_nowait(None)
+        upstream.followers.clear()
+
+    def _leave(self, upstream, queue):
+        # The last follower leaving closes the upstream, unless another one is still joining
+        upstream.followers.discard(queue)
+        if upstream.followers or upstream.joining or upstream.finished:
+            return
+        if self._upstreams.get(upstream.key) is upstream:
+            del self._upstreams[upstream.key]
+        threading.Thread(target=self._close, args=(upstream,), daemon=True).start()
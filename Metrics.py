@@ -0,0 +1,202 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter():
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Gauge(Counter):
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Histogram():
+    # Buckets are allocated once, observe() only bumps existing slots
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[slot] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", format_value(bound)),), cumulative
+        yield name + "_sum", labels, total
+        yield name + "_count", labels, cumulative
+
+class Family():
+    def __init__(self, name, help, type, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = labelnames
+        self.factory = factory
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        # Hot paths look their child up once and keep it
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " " + self.type)
+        for values, child in list(self.children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                lines.append(name + format_labels(labels) + " " + format_value(value))
+
+class Registry():
+    def __init__(self):
+        self.families = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Family(name, help, "counter", labelnames, Counter))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Family(name, help, "gauge", labelnames, Gauge))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Family(name, help, "histogram", labelnames, lambda: Histogram(buckets)))
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            family.render(lines)
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"')
+                          .replace("\n", "\\n") + '"' for key, value in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+registry = Registry()
+
+REQUESTS = registry.counter("api_requests_total", "HTTP requests by route and status code",
+                            ("method", "route", "status"))
+REQUEST_DURATION = registry.histogram("api_request_duration_seconds", "HTTP request latency by route",
+                                      ("method", "route"))
+REQUESTS_IN_FLIGHT = registry.gauge("api_requests_in_flight", "HTTP requests currently being served")
+BACKEND_CALLS = registry.counter("backend_calls_total", "Docker and libvirt calls by method",
+                                 ("backend", "method"))
+BACKEND_ERRORS = registry.counter("backend_errors_total", "Failed Docker and libvirt calls by exception",
+                                  ("backend", "method", "exception"))
+BACKEND_DURATION = registry.histogram("backend_call_duration_seconds", "Docker and libvirt call latency",
+                                      ("backend", "method"))
+BACKEND_IN_FLIGHT = registry.gauge("backend_calls_in_flight", "Docker and libvirt calls currently running",
+                                   ("backend", "method"))
+
+def instrument(obj, backend):
+    # Replaces the methods listed in API_METHODS on the instance, so every caller is measured.
+    # Helpers called per row or from inside other calls stay unwrapped
+    for name in obj.API_METHODS:
+        setattr(obj, name, instrument_method(getattr(obj, name), backend, name))
+    return obj
+
+def instrument_method(func, backend, name):
+    calls = BACKEND_CALLS.labels(backend, name)
+    duration = BACKEND_DURATION.labels(backend, name)
+    in_flight = BACKEND_IN_FLIGHT.labels(backend, name)
+
+    def failed(e):
+        BACKEND_ERRORS.labels(backend, name, type(e).__name__).inc()
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(*args, **kwargs):
+            calls.inc()
+            in_flight.inc()
+            start = time.perf_counter()
+            try:
+                yield from func(*args, **kwargs)
+            except Exception as e:
+                failed(e)
+                raise
+            finally:
+                duration.observe(time.perf_counter() - start)
+                in_flight.dec()
+        return generator
+
+    @functools.wraps(func)
+    def method(*args, **kwargs):
+        calls.inc()
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            failed(e)
+            raise
+        finally:
+            duration.observe(time.perf_counter() - start)
+            in_flight.dec()
+    return method
+
+class MetricsMiddleware():
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = REQUESTS_IN_FLIGHT.labels()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        response = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                response[0] = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # The route template keeps the label set bounded, unlike the raw path
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            REQUEST_DURATION.labels(scope["method"], path).observe(time.perf_counter() - start)
+            REQUESTS.labels(scope["method"], path, response[0]).inc()
+            self.in_flight.dec()
@@ -0,0 +1,262 @@
+import collections
+import json
+import os
+import threading
+import uuid
+import libvirt
+from libvirt import libvirtError
+from docker import errors
+from Exceptions import APIError, ArgumentNotFound
+from Images import normalize
+from Metrics import registry
+from Templates import build_domain, to_string
+from VM import domain_title
+
+WARM_POOLS = os.getenv("WARM_POOLS", "")
+WARM_POOL_REFILL_INTERVAL = float(os.getenv("WARM_POOL_REFILL_INTERVAL", "5"))
+WARM_POOL_BOOT_TIME = float(os.getenv("WARM_POOL_BOOT_TIME", "30"))
+POOL_LABEL = "virtualization-api.warm-pool"
+NAME_PREFIX = "warm-"
+
+CLAIMS = registry.counter("warm_pool_claims_total", "Run requests matching a warm pool by result",
+                          ("backend", "pool", "result"))
+REFILLS = registry.counter("warm_pool_refills_total", "Instances built for warm pools by result",
+                           ("backend", "pool", "result"))
+READY = registry.gauge("warm_pool_ready", "Instances waiting in a warm pool", ("backend", "pool"))
+
+def load_config(path=WARM_POOLS):
+    # {"containers": {"web": {"image": "nginx", "size": 2, "ports": {...}}},
+    #  "vms": {"debian": {"template": "debian12", "size": 1, "memory": 1048576, "vcpu": 1}}}
+    if not path:
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+class ContainerPool():
+    backend = "docker"
+
+    def __init__(self, name, config):
+        config = dict(config)
+        self.name = name
+        self.size = int(config.pop("size", 1))
+        self.image = normalize(config.pop("image"))
+        self.spec = {key: value for key, value in config.items() if value is not None}
+        self.ready = collections.deque()
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+    def matches(self, image, obj):
+        spec = {key: value for key, value in obj.dict().items()
+                if key not in ("name", "detach") and value is not None}
+        return normalize(image) == self.image and spec == self.spec
+
+class VMPool():
+    backend = "kvm-qemu"
+
+    def __init__(self, name, config):
+        self.name = name
+        self.size = int(config.get("size", 1))
+        self.template = config["template"]
+        self.memory = config["memory"]
+        self.vcpu = config["vcpu"]
+        self.disk_size = config.get("disk_size")
+        self.full_clone = config.get("full_clone", False)
+        self.ready = collections.deque()
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+    def matches(self, obj):
+        return (obj.template == self.template and obj.memory == self.memory and obj.vcpu == self.vcpu and
+                obj.disk_size == self.disk_size and obj.full_clone == self.full_clone and
+                not obj.source_file and obj.cloud_init is None)
+
+class WarmPools():
+    def __init__(self, docker, vm, config=None):
+        self.docker = docker
+        self.vm = vm
+        config = load_config() if config is None else config
+        self.pools = [ContainerPool(name, spec) for name, spec in config.get("containers", {}).items()]
+        self.pools += [VMPool(name, spec) for name, spec in config.get("vms", {}).items()]
+        self._lock = threading.Lock()
+        self._wake = {"docker": threading.Event(), "kvm-qemu": threading.Event()}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._refill, args=(backend,), name="warm-pool-" + backend,
+                                          daemon=True)
+                         for backend in self._wake if any(pool.backend == backend for pool in self.pools)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for event in self._wake.values():
+            event.set()
+
+    def claim_container(self, image, obj):
+        # Returns None if no pool matches or the pool is empty, the caller runs a fresh container then
+        pool = next((pool for pool in self.pools if pool.backend == "docker" and pool.matches(image, obj)), None)
+        if pool is None:
+            return None
+        while True:
+            id = self._take(pool)
+            if id is None:
+                self._record(pool, False)
+                return None
+            try:
+                container = self.docker.client.containers.get(id)
+            except errors.NotFound:
+                continue
+            except errors.APIError as e:
+                raise APIError(str(e.explanation))
+            if obj.name:
+                try:
+                    container.rename(obj.name)
+                except errors.APIError as e:
+                    self._put(pool, id)
+                    raise APIError(str(e.explanation))
+            self._record(pool, True)
+            try:
+                container.start()
+                container.reload()
+            except errors.APIError as e:
+                raise APIError(str(e.explanation))
+            return {"Following container sucessfully created": {
+                "Id": container.attrs.get("Id"), "Name": container.attrs.get("Name")
+                },
+                "info": "For further parameters visit: https://docker-py.readthedocs.io/en/stable/containers.html"}
+
+    def claim_vm(self, obj):
+        # A saved guest keeps its pool name, libvirt refuses to rename a domain
+        # with a managed save image, so the requested name becomes its title.
+        # The title also marks the guest as claimed for _adopt
+        if not obj.name:
+            raise ArgumentNotFound("name is required to claim a pooled guest")
+        pool = next((pool for pool in self.pools if pool.backend == "kvm-qemu" and pool.matches(obj)), None)
+        if pool is None:
+            return None
+        with self.vm.libvirt_connect() as conn:
+            try:
+                taken = any(obj.name in (dom.name(), domain_title(dom)) for dom in conn.listAllDomains())
+            except libvirtError as e:
+                raise APIError(str(e))
+            if taken:
+                raise APIError("Domain " + obj.name + " already exists")
+            while True:
+                id = self._take(pool)
+                if id is None:
+                    self._record(pool, False)
+                    return None
+                try:
+                    dom = conn.lookupByUUIDString(id)
+                except libvirtError:
+                    continue
+                self._record(pool, True)
+                try:
+                    dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_TITLE, obj.name, None, None,
+                                    libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+                    dom.create()
+                except libvirtError as e:
+                    raise APIError(str(e))
+                return {"Following guest sucessfully booted": {"Id": dom.UUIDString(), "Name": dom.name(),
+                                                               "Title": obj.name},
+                        "info": "For further parameters visit: https://libvirt.org/formatdomain.html"}
+
+    def stats(self):
+        with self._lock:
+            return [{"name": pool.name, "backend": pool.backend, "size": pool.size, "ready": len(pool.ready),
+                     "hits": pool.hits, "misses": pool.misses, "lastError": pool.last_error}
+                    for pool in self.pools]
+
+    def _take(self, pool):
+        with self._lock:
+            id = pool.ready.popleft() if pool.ready else None
+        READY.labels(pool.backend, pool.name).set(len(pool.ready))
+        self._wake[pool.backend].set()
+        return id
+
+    def _record(self, pool, hit):
+        with self._lock:
+            if hit:
+                pool.hits += 1
+            else:
+                pool.misses += 1
+        CLAIMS.labels(pool.backend, pool.name, "hit" if hit else "miss").inc()
+
+    def _put(self, pool, id):
+        with self._lock:
+            pool.ready.append(id)
+        READY.labels(pool.backend, pool.name).set(len(pool.ready))
+
+    def _refill(self, backend):
+        pools = [pool for pool in self.pools if pool.backend == backend]
+        for pool in pools:
+            try:
+                self._adopt(pool)
+            except Exception as e:
+                # Refilling still works without the instances of a previous run
+                pool.last_error = getattr(e, "message", str(e))
+        while not self._stop.is_set():
+            self._wake[backend].clear()
+            pool = next((pool for pool in pools if len(pool.ready) < pool.size), None)
+            if pool is None:
+                self._wake[backend].wait()
+                continue
+            try:
+                self._put(pool, self._build(pool))
+                pool.last_error = None
+                REFILLS.labels(pool.backend, pool.name, "ok").inc()
+            except Exception as e:
+                # Also transport errors and ConnectionFailed, the thread has to outlive a backend outage
+                pool.last_error = getattr(e, "message", str(e))
+                REFILLS.labels(pool.backend, pool.name, "error").inc()
+            # One new instance per interval and backend, refills never crowd out user requests
+            self._stop.wait(WARM_POOL_REFILL_INTERVAL)
+
+    def _adopt(self, pool):
+        # Instances built before a restart are taken over instead of rebuilt
+        if pool.backend == "docker":
+            try:
+                containers = self.docker.client.api.containers(all=True, filters={
+                    "label": POOL_LABEL + "=" + pool.name, "status": "created"})
+            except errors.APIError as e:
+                raise APIError(str(e.explanation))
+            for container in containers:
+                self._put(pool, container["Id"])
+            return
+        with self.vm.libvirt_connect() as conn:
+            for dom in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT):
+                if not dom.name().startswith(NAME_PREFIX + pool.name + "-") or domain_title(dom) is not None:
+                    continue
+                if dom.isActive():
+                    dom.managedSave(0)
+                if dom.hasManagedSaveImage(0):
+                    self._put(pool, dom.UUIDString())
+
+    def _build(self, pool):
+        name = NAME_PREFIX + pool.name + "-" + uuid.uuid4().hex[:8]
+        if pool.backend == "docker":
+            self.docker.image_manager.ensure(pool.image)
+            try:
+                spec = dict(pool.spec, labels=dict(pool.spec.get("labels") or {}, **{POOL_LABEL: pool.name}))
+                container = self.docker.client.containers.create(pool.image, name=name, **spec)
+            except errors.APIError as e:
+                raise APIError(str(e.explanation))
+            except TypeError as e:
+                raise ArgumentNotFound(e.args[0])
+            return container.id
+        self.vm.create_storage_vol(name, pool.disk_size, pool.template, pool.full_clone)
+        with self.vm.libvirt_connect() as conn:
+            dom = conn.defineXMLFlags(to_string(build_domain(name, pool.memory, pool.vcpu)), 0)
+            dom.create()
+            id = dom.UUIDString()
+        # The guest boots once, later claims resume it from the saved memory image
+        if self._stop.wait(WARM_POOL_BOOT_TIME):
+            raise APIError("Stopped while " + name + " was booting")
+        with self.vm.libvirt_connect() as conn:
+            conn.lookupByUUIDString(id).managedSave(0)
+        return id
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+from Exceptions import ResourceNotFound
+
+SHORT_ID_LENGTH = 12
+MIN_REFRESH_INTERVAL = 1.0
+
+class ResourceIndex():
+    def __init__(self, docker, vm, min_refresh_interval=MIN_REFRESH_INTERVAL):
+        self.docker = docker
+        self.vm = vm
+        self.min_refresh_interval = min_refresh_interval
+        self._index = {}
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self._valid = False
+        self._last_refresh = 0.0
+        self._refreshing = None
+
+    async def resolve(self, id):
+        entry = self._index.get(id)
+        if entry is None:
+            if not self._valid or time.monotonic() - self._last_refresh >= self.min_refresh_interval:
+                await self.refresh()
+            entry = self._index.get(id) or self._match_prefix(id)
+        if entry is None:
+            raise ResourceNotFound()
+        return entry
+
+    async def refresh(self):
+        # Concurrent misses share one rebuild instead of each walking both daemons
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._rebuild())
+        refreshing = self._refreshing
+        try:
+            await asyncio.shield(refreshing)
+        finally:
+            if self._refreshing is refreshing and refreshing.done():
+                self._refreshing = None
+
+    async def _rebuild(self):
+        containers, domains = await asyncio.gather(self.docker.list_container_ids(), 
+                                                   self.vm.list_vm_ids(),
+                                                   return_exceptions=True)
+        if isinstance(containers, Exception) and isinstance(domains, Exception):
+            raise containers
+        index = {}
+        aliases = {}
+        # A failing backend keeps its previous entries so it cannot block routing to the other
+        for backend, result in (("docker", containers), ("kvm-qemu", domains)):
+            if isinstance(result, Exception):
+                for id, keys in self._aliases.items():
+                    if self._index.get(id, (None,))[0] == backend:
+                        self._register(index, aliases, backend, id, *keys)
+            elif backend == "docker":
+                for id, names in result:
+                    self._register(index, aliases, backend, id, id[:SHORT_ID_LENGTH], *names)
+            else:
+                for uuid, name, title in result:
+                    # Claimed warm pool guests keep their pool name, the requested one is the title
+                    self._register(index, aliases, backend, uuid, name, title)
+        with self._lock:
+            self._index = index
+            self._aliases = aliases
+            self._valid = True
+            self._last_refresh = time.monotonic()
+
+    def add(self, backend, id, *names):
+        if backend == "docker":
+            names = (id[:SHORT_ID_LENGTH],) + names
+        with self._lock:
+            self._register(self._index, self._aliases, backend, id, *names)
+
+    def remove(self, id):
+        with self._lock:
+            entry = self._index.get(id)
+            if entry is None:
+                return
+            for alias in self._aliases.pop(entry[1], ()):
+                self._index.pop(alias, None)
+
+    def invalidate(self):
+        self._valid = False
+
+    def _register(self, index, aliases, backend, id, *names):
+        entry = (backend, id)
+        keys = {id, *(name for name in names if name)}
+        for key in keys:
+            index[key] = entry
+        aliases[id] = aliases.get(id, set()) | keys
+
+    def _match_prefix(self, id):
+        # Docker also accepts any unique prefix of a container id
+        with self._lock:
+            entries = list(self._index.items())
+        matches = {entry for key, entry in entries
+                   if entry[0] == "docker" and key == entry[1] and key.startswith(id)}
+        if len(matches) == 1:
+            return matches.pop()
+        return None
@@ -1,8 +1,13 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Union,Annotated
 import time
-from fastapi import Depends, HTTPException, Security , status
+from fastapi import Depends, HTTPException, Security , WebSocket, WebSocketException, status
 from fastapi.security import (
     OAuth2PasswordBearer, 
     OAuth2PasswordRequestForm,
@@ -15,6 +20,8 @@ from pydantic import BaseModel, ValidationError
 SECRET_KEY = "b18cddaef06d377b97f01a3de062a2e1ec2cca8cf9a37b543786b9227155ae64"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", "2"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
 
 fake_users_db = {
     "johndoe": {
@@ -65,16 +72,73 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+# bcrypt releases the GIL, so a small thread pool keeps logins off the event loop
+# and caps how many CPU heavy verifications run at once
+password_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="bcrypt")
 
-def authenticate_user(fake_db, username: str, password: str):
-    user = get_user(fake_db, username)
+class UserStore():
+    # Subclasses only need to override load() to read users from elsewhere
+    def __init__(self, users):
+        self.users = users
+        self._cache = {}
+
+    def load(self, username: str):
+        return self.users.get(username)
+
+    def get(self, username: str):
+        user = self._cache.get(username)
+        if user is None:
+            user_dict = self.load(username)
+            if user_dict is None:
+                return None
+            user = self._cache[username] = UserInDB(**user_dict)
+        return user
+
+    def disable(self, username: str):
+        user_dict = self.load(username)
+        if user_dict is not None:
+            user_dict["disabled"] = True
+        self.invalidate(username)
+
+    def invalidate(self, username: str | None = None):
+        if username is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(username, None)
+
+class TokenCache():
+    def __init__(self, size=TOKEN_CACHE_SIZE):
+        self.size = size
+        self._tokens = OrderedDict()
+
+    def get(self, token: str):
+        key = hashlib.sha256(token.encode()).digest()
+        entry = self._tokens.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._tokens[key]
+            return None
+        self._tokens.move_to_end(key)
+        return entry[1]
+
+    def put(self, token: str, exp, token_data):
+        self._tokens[hashlib.sha256(token.encode()).digest()] = (exp, token_data)
+        if len(self._tokens) > self.size:
+            self._tokens.popitem(last=False)
+
+user_store = UserStore(fake_users_db)
+token_cache = TokenCache()
+
+def get_user(store, username: str):
+    return store.get(username)
+
+async def authenticate_user(store, username: str, password: str):
+    user = get_user(store, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(password_executor, verify_password, password, user.hashed_password):
         return False
     return user
 
@@ -100,16 +164,21 @@ async def get_current_active_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    token_data = token_cache.get(token)
+    if token_data is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_scopes = payload.get("scopes", [])
+            token_data = TokenData(scopes=token_scopes, username=username)
+        except (JWTError, ValidationError):
             raise credentials_exception
-        token_scopes = payload.get("scopes", [])
-        token_data = TokenData(scopes=token_scopes, username=username)
-    except (JWTError, ValidationError):
-        raise credentials_exception
-    user = get_user(fake_users_db, username=token_data.username)
+        # Tokens without exp never expire in jose, those are not worth caching
+        if isinstance(payload.get("exp"), (int, float)):
+            token_cache.put(token, payload["exp"], token_data)
+    user = get_user(user_store, username=token_data.username)
     if user is None:
         raise credentials_exception
     
@@ -122,4 +191,15 @@ async def get_current_active_user(
             )
     if user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
-    return user
\ No newline at end of file
+    return user
+
+async def get_websocket_user(security_scopes: SecurityScopes, websocket: WebSocket):
+    # Browsers cannot set headers on a WebSocket, the token may come as query parameter
+    authorization = websocket.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else websocket.query_params.get("token")
+    if not token:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Not authenticated")
+    try:
+        return await get_current_active_user(security_scopes, token)
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
@@ -0,0 +1,237 @@
+import asyncio
+import os
+import threading
+import time
+import libvirt
+from libvirt import libvirtError
+from docker import errors
+from Exceptions import APIError, ConnectionFailed
+
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", "1"))
+SUBSCRIBER_BUFFER = 10
+
+DOMAIN_STATS = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU |
+                libvirt.VIR_DOMAIN_STATS_BLOCK | libvirt.VIR_DOMAIN_STATS_INTERFACE)
+
+def rate(current, previous, elapsed):
+    if previous is None or current is None or elapsed <= 0 or current < previous:
+        return None
+    return (current - previous) / elapsed
+
+def sum_indexed(record, group, field):
+    return sum(record.get(group + "." + str(i) + "." + field, 0) for i in range(record.get(group + ".count", 0)))
+
+def domain_counters(record):
+    return {"cpu": record.get("cpu.time"),
+            "blockRead": sum_indexed(record, "block", "rd.bytes"),
+            "blockWrite": sum_indexed(record, "block", "wr.bytes"),
+            "netRx": sum_indexed(record, "net", "rx.bytes"),
+            "netTx": sum_indexed(record, "net", "tx.bytes")}
+
+def container_counters(stats):
+    blkio = (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+    networks = (stats.get("networks") or {}).values()
+    return {"blockRead": sum(entry["value"] for entry in blkio if entry.get("op", "").lower() == "read"),
+            "blockWrite": sum(entry["value"] for entry in blkio if entry.get("op", "").lower() == "write"),
+            "netRx": sum(network.get("rx_bytes", 0) for network in networks),
+            "netTx": sum(network.get("tx_bytes", 0) for network in networks)}
+
+def io_rates(counters, previous, elapsed):
+    previous = previous or {}
+    return {"blockReadBytesPerSec": rate(counters["blockRead"], previous.get("blockRead"), elapsed),
+            "blockWriteBytesPerSec": rate(counters["blockWrite"], previous.get("blockWrite"), elapsed),
+            "netRxBytesPerSec": rate(counters["netRx"], previous.get("netRx"), elapsed),
+            "netTxBytesPerSec": rate(counters["netTx"], previous.get("netTx"), elapsed)}
+
+def domain_sample(uuid, record, counters, previous, elapsed):
+    cpu = rate(counters["cpu"], (previous or {}).get("cpu"), elapsed)
+    vcpus = record.get("vcpu.current") or 1
+    # Guests with a balloon driver report what they use, rss is the fallback
+    if "balloon.available" in record and "balloon.unused" in record:
+        used = (record["balloon.available"] - record["balloon.unused"]) * 1024
+    else:
+        used = record["balloon.rss"] * 1024 if "balloon.rss" in record else None
+    limit = record.get("balloon.current") or record.get("balloon.maximum")
+    return {"id": uuid,
+            "backend": "kvm-qemu",
+            "timestamp": time.time(),
+            "state": record.get("state.state"),
+            "cpuPercent": cpu / 1e9 / vcpus * 100 if cpu is not None else None,
+            "memoryUsed": used,
+            "memoryLimit": limit * 1024 if limit else None,
+            **io_rates(counters, previous, elapsed)}
+
+def container_sample(id, stats, counters, previous, elapsed):
+    cpu_stats = stats.get("cpu_stats") or {}
+    precpu_stats = stats.get("precpu_stats") or {}
+    cpu_delta = (cpu_stats.get("cpu_usage", {}).get("total_usage", 0) -
+                 precpu_stats.get("cpu_usage", {}).get("total_usage", 0))
+    system_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get("system_cpu_usage", 0)
+    cpus = cpu_stats.get("online_cpus") or len(cpu_stats.get("cpu_usage", {}).get("percpu_usage") or []) or 1
+    memory = stats.get("memory_stats") or {}
+    # Page cache is reclaimable, docker stats subtracts it the same way
+    cache = (memory.get("stats") or {}).get("inactive_file", (memory.get("stats") or {}).get("cache", 0))
+    return {"id": id,
+            "backend": "docker",
+            "timestamp": time.time(),
+            "state": None,
+            "cpuPercent": cpu_delta / system_delta * cpus * 100 if system_delta > 0 and cpu_delta >= 0 else None,
+            "memoryUsed": memory["usage"] - cache if "usage" in memory else None,
+            "memoryLimit": memory.get("limit"),
+            **io_rates(counters, previous, elapsed)}
+
+class Telemetry():
+    def __init__(self, docker, vm, interval=TELEMETRY_INTERVAL):
+        self.docker = docker
+        self.vm = vm
+        self.interval = interval
+        self._subscribers = {}
+        self._samplers = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    async def subscribe(self, resources):
+        # All subscribers of a resource share its sampler, it stops with the last one
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(SUBSCRIBER_BUFFER)
+        with self._lock:
+            for resource in resources:
+                self._subscribers.setdefault(resource, set()).add(queue)
+                self._start(resource)
+        try:
+            while True:
+                sample = await queue.get()
+                if sample is None:
+                    return
+                yield sample
+        finally:
+            self._unsubscribe(queue)
+
+    def stats(self):
+        with self._lock:
+            return {"samplers": sorted(backend + ("/" + key if key else "") for backend, key in self._samplers),
+                    "subscribers": {backend + "/" + key: len(queues)
+                                    for (backend, key), queues in self._subscribers.items()}}
+
+    def _start(self, resource):
+        backend, key = resource
+        sampler = ("kvm-qemu", None) if backend == "kvm-qemu" else resource
+        if sampler in self._samplers:
+            return
+        if backend == "kvm-qemu":
+            thread = threading.Thread(target=self._sample_domains, name="telemetry-libvirt", daemon=True)
+        else:
+            thread = threading.Thread(target=self._sample_container, args=(key,), name="telemetry-" + key[:12],
+                                      daemon=True)
+        self._samplers[sampler] = thread
+        thread.start()
+
+    def _unsubscribe(self, queue):
+        with self._lock:
+            for resource, queues in list(self._subscribers.items()):
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[resource]
+
+    def _watched(self, resource, sampler):
+        # Checked and cleared under the lock, a new subscriber then starts a fresh sampler
+        with self._lock:
+            if any(key == resource or (resource is None and key[0] == sampler[0]) for key in self._subscribers):
+                return True
+            self._samplers.pop(sampler, None)
+            return False
+
+    def _sample_container(self, id):
+        resource = ("docker", id)
+        previous = None
+        last = None
+        stream = None
+        try:
+            stream = self.docker.client.api.stats(id, stream=True, decode=True)
+            for stats in stream:
+                if not self._watched(resource, resource):
+                    return
+                now = time.monotonic()
+                counters = container_counters(stats)
+                self._publish(resource, container_sample(id, stats, counters, previous,
+                                                         now - last if last else 0))
+                previous, last = counters, now
+            self._fail(resource, resource, "Container " + id + " stopped reporting stats")
+        except errors.NotFound:
+            self._fail(resource, resource, "Container " + id + " not found")
+        except errors.APIError as e:
+            self._fail(resource, resource, str(e.explanation))
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def _sample_domains(self):
+        # One bulk stats call per interval covers every watched domain
+        sampler = ("kvm-qemu", None)
+        previous = {}
+        while self._watched(None, sampler):
+            with self._lock:
+                uuids = [key for backend, key in self._subscribers if backend == "kvm-qemu"]
+            try:
+                with self.vm.libvirt_connect() as conn:
+                    doms = []
+                    for uuid in uuids:
+                        try:
+                            doms.append(conn.lookupByUUIDString(uuid))
+                        except libvirtError:
+                            self._fail(("kvm-qemu", uuid), None, "Domain " + uuid + " not found")
+                    records = conn.domainListGetStats(doms, DOMAIN_STATS) if doms else []
+            except (libvirtError, APIError, ConnectionFailed):
+                records = []
+            now = time.monotonic()
+            for dom, record in records:
+                uuid = dom.UUIDString()
+                counters = domain_counters(record)
+                last, before = previous.get(uuid, (None, None))
+                self._publish(("kvm-qemu", uuid), domain_sample(uuid, record, counters, before,
+                                                                now - last if last else 0))
+                previous[uuid] = (now, counters)
+            for uuid in set(previous) - set(uuids):
+                del previous[uuid]
+            time.sleep(self.interval)
+
+    def _fail(self, resource, sampler, message):
+        self._publish(resource, {"id": resource[1], "backend": resource[0], "error": message})
+        with self._lock:
+            if sampler is not None:
+                self._samplers.pop(sampler, None)
+        self._call(self._close, resource)
+
+    def _publish(self, resource, sample):
+        self._call(self._deliver, resource, sample)
+
+    def _call(self, func, *args):
+        try:
+            self._loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            pass
+
+    def _deliver(self, resource, sample):
+        # Runs on the event loop, a subscriber whose buffer is full is dropped
+        with self._lock:
+            queues = list(self._subscribers.get(resource, ()))
+        for queue in queues:
+            try:
+                queue.put_nowait(sample)
+            except asyncio.QueueFull:
+                self._unsubscribe(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _close(self, resource):
+        # Ends the streams that watched nothing but the vanished resource
+        with self._lock:
+            queues = self._subscribers.pop(resource, set())
+            watching = set().union(*self._subscribers.values()) if self._subscribers else set()
+        for queue in queues - watching:
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                queue.get_nowait()
+                queue.put_nowait(None)
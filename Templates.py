@@ -0,0 +1,151 @@
+import copy
+import functools
+import io
+import os
+from lxml import etree
+try:
+    import pycdlib
+except ImportError:
+    pycdlib = None
+from Exceptions import ArgumentNotFound
+
+SCHEMA_DIR = os.getenv("LIBVIRT_SCHEMA_DIR", "/usr/share/libvirt/schemas")
+IMAGE_DIR = "/var/lib/libvirt/images"
+
+# Parsed once, builders only copy the tree and fill in values, lxml escapes them
+_parser = etree.XMLParser(remove_blank_text=True)
+_safe_parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+
+DOMAIN_TEMPLATE = etree.fromstring("""
+<domain type='kvm'>
+    <name/>
+    <memory/>
+    <vcpu/>
+    <os>
+        <type>hvm</type>
+        <boot dev='hd'/>
+        <boot dev='cdrom'/>
+    </os>
+    <clock offset='utc'/>
+    <on_poweroff>destroy</on_poweroff>
+    <on_reboot>restart</on_reboot>
+    <on_crash>destroy</on_crash>
+    <devices>
+        <emulator>/usr/bin/qemu-system-x86_64</emulator>
+        <disk type='file' device='cdrom'>
+            <source/>
+            <driver name='qemu' type='raw'/>
+            <target dev='hda'/>
+        </disk>
+        <disk type='file' device='disk'>
+            <driver name='qemu' type='qcow2'/>
+            <source/>
+            <target dev='vda'/>
+        </disk>
+        <interface type='network'>
+            <source network='default'/>
+        </interface>
+        <input type='mouse' bus='ps2'/>
+        <graphics type='vnc' port='-1' listen='127.0.0.1'/>
+    </devices>
+</domain>""", _parser)
+
+VOLUME_TEMPLATE = etree.fromstring("""
+<volume type='file'>
+    <name/>
+    <allocation>0</allocation>
+    <capacity>0</capacity>
+    <target>
+        <path/>
+        <format type='qcow2'/>
+        <permissions>
+            <owner>107</owner>
+            <group>107</group>
+            <mode>0744</mode>
+            <label>vir_image_t</label>
+        </permissions>
+    </target>
+</volume>""", _parser)
+
+SNAPSHOT_TEMPLATE = etree.fromstring("<domainsnapshot><name/></domainsnapshot>", _parser)
+
+def build_domain(name, memory, vcpu, source_file=None, disk_path=None, seed_path=None):
+    domain = copy.deepcopy(DOMAIN_TEMPLATE)
+    domain.find("name").text = name
+    domain.find("memory").text = str(int(memory))
+    domain.find("vcpu").text = str(int(vcpu))
+    cdrom, disk = domain.findall("devices/disk")
+    disk.find("source").set("file", disk_path or IMAGE_DIR + "/" + name + ".qcow2")
+    if seed_path:
+        seed = copy.deepcopy(cdrom)
+        seed.find("source").set("file", seed_path)
+        seed.find("target").set("dev", "hdb")
+        disk.addnext(seed)
+    if source_file:
+        cdrom.find("source").set("file", source_file)
+    else:
+        cdrom.getparent().remove(cdrom)
+    return domain
+
+def build_volume(name, path, capacity=0, allocation=0, format="qcow2", backing_path=None, backing_format=None):
+    volume = copy.deepcopy(VOLUME_TEMPLATE)
+    volume.find("name").text = name
+    volume.find("capacity").text = str(int(capacity))
+    volume.find("allocation").text = str(int(allocation))
+    volume.find("target/path").text = path
+    volume.find("target/format").set("type", format)
+    if backing_path:
+        # A qcow2 overlay only records its differences to the backing image
+        backing = etree.SubElement(volume, "backingStore")
+        etree.SubElement(backing, "path").text = backing_path
+        etree.SubElement(backing, "format").set("type", backing_format or "qcow2")
+    return volume
+
+def build_seed_iso(name, user_data, meta_data=None, network_config=None):
+    # NoCloud datasource: an ISO labelled cidata with user-data and meta-data
+    if pycdlib is None:
+        raise ArgumentNotFound("cloud_init needs the optional pycdlib package")
+    files = {"user-data": user_data,
+             "meta-data": meta_data or "instance-id: " + name + "\nlocal-hostname: " + name + "\n"}
+    if network_config:
+        files["network-config"] = network_config
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange=3, joliet=3, rock_ridge="1.09", vol_ident="cidata")
+    for filename, content in files.items():
+        data = content.encode()
+        iso.add_fp(io.BytesIO(data), len(data), "/" + filename.replace("-", "").upper() + ".;1",
+                   rr_name=filename, joliet_path="/" + filename)
+    output = io.BytesIO()
+    iso.write_fp(output)
+    iso.close()
+    return output.getvalue()
+
+def build_snapshot(name):
+    snapshot = copy.deepcopy(SNAPSHOT_TEMPLATE)
+    snapshot.find("name").text = name
+    return snapshot
+
+def to_string(element):
+    return etree.tostring(element, encoding="unicode")
+
+@functools.lru_cache(maxsize=None)
+def load_schema(name):
+    # libvirt ships its RelaxNG schemas with the daemon, they are optional here
+    path = os.path.join(SCHEMA_DIR, name + ".rng")
+    if not os.path.exists(path):
+        return None
+    return etree.RelaxNG(etree.parse(path))
+
+def validate(body, name):
+    # Returns False if no local schema exists, libvirt has to validate then
+    schema = load_schema(name)
+    if schema is None:
+        return False
+    try:
+        document = etree.fromstring(body, _safe_parser)
+    except etree.XMLSyntaxError as e:
+        raise ArgumentNotFound("Invalid XML: " + str(e))
+    if not schema.validate(document):
+        raise ArgumentNotFound("XML does not match the libvirt " + name + " schema: " +
+                               str(schema.error_log.last_error))
+    return True
@@ -1,20 +1,39 @@
+import io
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Union
 import libvirt
 from libvirt import libvirtError
 from pydantic import BaseModel
-import xml.dom.minidom    
 from lxml import etree
+from Listing import lookup_field
+from Connection import ConnectionPool, LIBVIRT_URI, POOL_SIZE, start_event_loop
+from Templates import (
+    IMAGE_DIR, build_domain, build_seed_iso, build_snapshot, build_volume, to_string, validate
+)
 from Exceptions import (
-    APIError, ConnectionFailed, ResourceNotFound, 
+    APIError, ArgumentNotFound, ConnectionFailed, ResourceNotFound, 
     ResourceAlreadyRunning, ResourceNotRunning, ResourceRunning
 )
 
+class CloudInitObj(BaseModel):
+    user_data: str
+    meta_data: Union[str, None] = None
+    network_config: Union[str, None] = None
+
 class DomainObj(BaseModel):
     name: Union[str, None] = None
     memory: int
     vcpu: int
-    source_file: str
+    source_file: Union[str, None] = None
+    template: Union[str, None] = None
+    disk_size: Union[int, None] = None
+    full_clone: bool = False
+    cloud_init: Union[CloudInitObj, None] = None
     
     class Config:
             schema_extra = {
@@ -26,304 +45,584 @@ class DomainObj(BaseModel):
                 }
             }
 
+STATUS_DESC = {
+    libvirt.VIR_DOMAIN_RUNNING: "Running",
+    libvirt.VIR_DOMAIN_PAUSED: "Stopped(Paused)",
+    libvirt.VIR_DOMAIN_SHUTOFF: "Not Running"
+}
+
+STORAGE_CACHE_TTL = float(os.getenv("STORAGE_CACHE_TTL", "60"))
+FILE_POOL_TYPES = ("dir", "fs", "netfs")
+SNAPSHOT_CACHE_TTL = float(os.getenv("SNAPSHOT_CACHE_TTL", "60"))
+
+# Older bindings lack the flag, libvirt then only checks that the XML parses
+VALIDATE_FLAG = getattr(libvirt, "VIR_DOMAIN_DEFINE_VALIDATE", 0)
+
+TEMPLATE_POOL = os.getenv("TEMPLATE_POOL", "templates")
+GIB = 1024 ** 3
+UPLOAD_CHUNK = 256 * 1024
+
+STATS_GROUPS = {
+    "cpu": libvirt.VIR_DOMAIN_STATS_CPU_TOTAL,
+    "balloon": libvirt.VIR_DOMAIN_STATS_BALLOON,
+    "block": libvirt.VIR_DOMAIN_STATS_BLOCK,
+    "net": libvirt.VIR_DOMAIN_STATS_INTERFACE
+}
+
+def domain_title(dom):
+    # libvirt reports a missing title as an error
+    try:
+        return dom.metadata(libvirt.VIR_DOMAIN_METADATA_TITLE, None) or None
+    except libvirtError:
+        return None
+
+def parse_snapshot_xml(desc):
+    # Stops at the embedded <domain>, which makes up most of the document
+    meta = {"name": None, "state": None, "creationTime": None, "memory": None, "parent": None}
+    depth = 0
+    for event, elem in etree.iterparse(io.BytesIO(desc.encode()), events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and elem.tag == "domain":
+                break
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag in ("name", "state", "creationTime"):
+            meta[elem.tag] = elem.text
+        elif depth == 1 and elem.tag == "memory":
+            meta["memory"] = elem.get("snapshot")
+        elif depth == 2 and elem.tag == "name" and elem.getparent().tag == "parent":
+            meta["parent"] = elem.text
+    return meta
+
 class VM():   
-    def list_vms(self):
-        conn = self.libvirt_connect()
-        domains = {}
-        domains = conn.listAllDomains()
-        jsonList = []
-        for dom in domains:
-            jsonList.append({"uuid": dom.UUIDString(),
-                            "name": dom.name(),
-                            "isActive": dom.isActive(),
-                            "status": self.get_vm_status(dom).get("desc"),
-                            "isPersistent": dom.isPersistent()})
-        return jsonList
+    # Calls measured by Metrics.instrument, the list_* wrappers only collect their iter_* generator
+    API_METHODS = ("iter_vms", "list_snapshots", "get_snapshot_tree", "count_snapshots", "iter_storage_vol",
+                   "get_vm_summary", "get_vm_info", "open_console", "start_vm", "stop_vm", "reboot_vm",
+                   "shutdown_vm", "delete_vm", "delete_snapshot", "delete_storage_vol", "run_vm_xml",
+                   "run_vm_json", "create_snapshot", "create_storage_vol", "create_seed_vol", "list_templates",
+                   "get_job_progress", "abort_job", "list_vm_ids", "get_vm_title")
+
+    def __init__(self, uri=LIBVIRT_URI, pool_size=POOL_SIZE):
+        start_event_loop()
+        self.pool = ConnectionPool(uri, pool_size)
+        self._storage_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="libvirt-storage")
+        self._storage_locks = defaultdict(threading.Lock)
+        self._storage_cache = {}
+        self._storage_generation = {}
+        self._snapshot_locks = defaultdict(threading.Lock)
+        self._snapshot_cache = {}
+        self._snapshot_generation = {}
+
+    def list_vms(self, stats=None):
+        return list(self.iter_vms(stats))
+
+    def iter_vms(self, stats=None):
+        groups = self.parse_stats_groups(stats)
+        flags = libvirt.VIR_DOMAIN_STATS_STATE
+        for group in groups:
+            flags |= STATS_GROUPS[group]
+        with self.libvirt_connect() as conn:
+            try:
+                records = conn.getAllDomainStats(flags)
+                persistent = {dom.UUIDString() for dom in 
+                              conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT)}
+            except libvirtError as e:
+                raise APIError(str(e))
+        for dom, record in records:
+            yield self.build_vm_summary(dom, record, dom.UUIDString() in persistent, groups)
     
-    def list_snapshots(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        snapshots = dom.listAllSnapshots()
-        jsonList = []
-        for elem in snapshots:
-            xmlDesc = etree.fromstring(elem.getXMLDesc())
-            creationTime = datetime.fromtimestamp(int(xmlDesc.find("creationTime").text))
-            jsonList.append({"name": elem.getName(),
-                             "timestamp": creationTime,
-                             "state": xmlDesc.find("state").text,
-                             "isCurrent": elem.isCurrent(),
-                             "memorySnapshot": xmlDesc.find("memory").get("snapshot")})                             
+    def list_snapshots(self, id, limit=None, since=None):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            entry = self.get_snapshot_metadata(dom)
+        jsonList = [self.build_snapshot(meta, entry["current"]) for meta in entry["snapshots"].values()]
+        jsonList.sort(key=lambda snapshot: snapshot["timestamp"], reverse=True)
+        if since is not None:
+            if since.tzinfo is not None:
+                since = since.astimezone().replace(tzinfo=None)
+            jsonList = [snapshot for snapshot in jsonList if snapshot["timestamp"] > since]
+        if limit is not None:
+            jsonList = jsonList[:limit]
         return jsonList
+
+    def get_snapshot_tree(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            entry = self.get_snapshot_metadata(dom)
+        nodes = {name: {**self.build_snapshot(meta, entry["current"]), "children": []} 
+                 for name, meta in entry["snapshots"].items()}
+        roots = []
+        for node in sorted(nodes.values(), key=lambda node: node["timestamp"]):
+            parent = nodes.get(node["parent"])
+            (parent["children"] if parent is not None else roots).append(node)
+        return roots
+
+    def count_snapshots(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            entry = self._snapshot_cache.get(dom.UUIDString())
+            if self.snapshot_cache_valid(dom.UUIDString(), entry):
+                return len(entry["snapshots"])
+            try:
+                return dom.snapshotNum()
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def get_snapshot_metadata(self, dom):
+        # Only snapshots not seen before are fetched and parsed again
+        uuid = dom.UUIDString()
+        with self._snapshot_locks[uuid]:
+            entry = self._snapshot_cache.get(uuid)
+            if self.snapshot_cache_valid(uuid, entry):
+                return entry
+            generation = self._snapshot_generation.get(uuid, 0)
+            known = entry["snapshots"] if entry is not None else {}
+            snapshots = {}
+            try:
+                for snapshot in dom.listAllSnapshots():
+                    name = snapshot.getName()
+                    snapshots[name] = known.get(name) or parse_snapshot_xml(snapshot.getXMLDesc())
+                current = dom.snapshotCurrent().getName() if dom.hasCurrentSnapshot() else None
+            except libvirtError as e:
+                raise APIError(str(e))
+            entry = {"generation": generation, "time": time.monotonic(), 
+                     "snapshots": snapshots, "current": current}
+            self._snapshot_cache[uuid] = entry
+            return entry
+
+    def snapshot_cache_valid(self, uuid, entry):
+        return (entry is not None and entry["generation"] == self._snapshot_generation.get(uuid, 0) 
+                and time.monotonic() - entry["time"] < SNAPSHOT_CACHE_TTL)
+
+    def invalidate_snapshots(self, id, name=None):
+        self._snapshot_generation[id] = self._snapshot_generation.get(id, 0) + 1
+        entry = self._snapshot_cache.get(id)
+        if name is not None and entry is not None:
+            entry["snapshots"].pop(name, None)
+
+    def forget_snapshots(self, id):
+        self._snapshot_cache.pop(id, None)
+        self._snapshot_generation.pop(id, None)
+
+    def build_snapshot(self, meta, current):
+        return {"name": meta["name"],
+                "timestamp": datetime.fromtimestamp(int(meta["creationTime"])),
+                "state": meta["state"],
+                "isCurrent": meta["name"] == current,
+                "memorySnapshot": meta["memory"],
+                "parent": meta["parent"]}
     
-    def list_storage_vol(self):
-        conn = self.libvirt_connect()
-        pool = conn.storagePoolLookupByName("default")
-        if pool == None:
-            raise APIError("Failed to locate any StoragePool objects")
-        stgvols = pool.listVolumes()
-        jsonList = []
-        for stgvolname in stgvols:
-            stgvol = pool.storageVolLookupByName(stgvolname)
-            info = stgvol.info()
-            jsonList.append({"name": stgvolname,
-                             "path": stgvol.path(),
-                             "Type": str(info[0]),
-                             "Capacity": str(info[1]),
-                             "Allocation": str(info[2])})
-        return jsonList
+    def list_storage_vol(self, pool=None):
+        return list(self.iter_storage_vol(pool))
 
-    def get_vm_info(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        state, maxmem, mem, cpus, cput = dom.info()
-        return {"uuid": dom.UUIDString(),
-                "name": dom.name(),
-                "isActive": dom.isActive(),
-                "status": self.get_vm_status(dom).get("desc"),
-                "isPersistent": dom.isPersistent(),
-                "OSType": dom.OSType(),
-                "hasCurrentSnapshot": dom.hasCurrentSnapshot(),
-                "hardware_info": {
-                    "state": str(state),
-                    "maxMemory": str(maxmem),
-                    "memory": str(mem),
-                    "cpuNum": str(cpus),
-                    "cpuTime": str(cput)}}
+    def iter_storage_vol(self, pool=None):
+        with self.libvirt_connect() as conn:
+            try:
+                pools = [(stgpool.name(), etree.fromstring(stgpool.XMLDesc()).get("type")) 
+                         for stgpool in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE)]
+            except libvirtError as e:
+                raise APIError(str(e))
+        if pool is not None:
+            pools = [entry for entry in pools if entry[0] == pool]
+            if not pools:
+                raise ArgumentNotFound("Unknown storage pool " + pool)
+        # Pools refresh concurrently, each on its own connection
+        futures = [self._storage_executor.submit(self.get_pool_volumes, name, type) for name, type in pools]
+        for future in futures:
+            yield from future.result()
 
-    def start_vm(self, id, revertSnapshot):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
+    def get_pool_volumes(self, name, type=None):
+        with self._storage_locks[name]:
+            cached = self._storage_cache.get(name)
+            if cached is not None and time.monotonic() - cached[0] < STORAGE_CACHE_TTL:
+                return cached[1]
+            generation = self._storage_generation.get(name, 0)
+            with self.libvirt_connect() as conn:
+                try:
+                    stgpool = conn.storagePoolLookupByName(name)
+                    rows = []
+                    for stgvol in stgpool.listAllVolumes():
+                        info = stgvol.info()
+                        rows.append({"name": stgvol.name(),
+                                     # For file based pools the key is the path, which saves one RPC per volume
+                                     "path": stgvol.key() if type in FILE_POOL_TYPES else stgvol.path(),
+                                     "pool": name,
+                                     "Type": str(info[0]),
+                                     "Capacity": str(info[1]),
+                                     "Allocation": str(info[2])})
+                except libvirtError as e:
+                    raise APIError(str(e))
+            # A volume created or deleted during the walk may be missing, so do not cache it
+            if self._storage_generation.get(name, 0) == generation:
+                self._storage_cache[name] = (time.monotonic(), rows)
+            return rows
+
+    def invalidate_storage(self, pool=None):
+        for name in [pool] if pool is not None else list(self._storage_cache):
+            self._storage_generation[name] = self._storage_generation.get(name, 0) + 1
+            self._storage_cache.pop(name, None)
+
+    def get_vm_summary(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                (dom, record), = conn.domainListGetStats([dom], libvirt.VIR_DOMAIN_STATS_STATE)
+                return self.build_vm_summary(dom, record, dom.isPersistent())
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def get_vm_info(self, id, fields=None):
+        # Every entry costs a libvirt call, a projection only pays for the entries it names
+        getters = {"uuid": lambda dom: dom.UUIDString(),
+                   "name": lambda dom: dom.name(),
+                   "isActive": lambda dom: dom.isActive(),
+                   "status": lambda dom: self.get_vm_status(dom).get("desc"),
+                   "isPersistent": lambda dom: dom.isPersistent(),
+                   "OSType": lambda dom: dom.OSType(),
+                   "hasCurrentSnapshot": lambda dom: dom.hasCurrentSnapshot(),
+                   "hardware_info": self.get_hardware_info}
+        wanted = {field.split(".", 1)[0] for field in fields} if fields else getters
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                info = {key: getter(dom) for key, getter in getters.items() if key in wanted}
+            except libvirtError as e:
+                raise APIError(str(e))
+        if fields:
+            return {field: lookup_field(info, field) for field in fields}
+        return info
+
+    def open_console(self, id):
+        # The console gets a connection of its own, it stays open as long as someone follows it
         try:
-            if revertSnapshot:
-                snapshot = dom.snapshotLookupByName(revertSnapshot)
-                dom.revertToSnapshot(snapshot)
-                return "Sucessfully reverted " + revertSnapshot
-            state = self.get_vm_status(dom).get("state")
-            if state == 3:
-                dom.resume()
-                return "VM sucessfully resumed"
-            elif state == 5:
-                dom.create()
-                return "VM sucessfully restarted"
-            elif state == 1:
-                raise ResourceAlreadyRunning()
-        except libvirtError as e:
-            raise APIError(str(e))            
-    
-    def stop_vm(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
+            conn = libvirt.open(self.pool.uri)
+        except libvirtError:
+            raise ConnectionFailed()
         try:
-            state = self.get_vm_status(dom).get("state")
-            if state == 1:
-                dom.suspend()
-                return "VM sucessfully stopped"
-            else:
-                raise ResourceNotRunning()
+            dom = self.get_vm(id, conn)
+            stream = conn.newStream(0)
+            dom.openConsole(None, stream, libvirt.VIR_DOMAIN_CONSOLE_SAFE)
         except libvirtError as e:
+            conn.close()
             raise APIError(str(e))
+        except ResourceNotFound:
+            conn.close()
+            raise
+        return conn, stream
+
+    def get_hardware_info(self, dom):
+        state, maxmem, mem, cpus, cput = dom.info()
+        return {"state": state,
+                "maxMemory": maxmem,
+                "memory": mem,
+                "cpuNum": cpus,
+                "cpuTime": cput}
+
+    def start_vm(self, id, revertSnapshot):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                if revertSnapshot:
+                    snapshot = dom.snapshotLookupByName(revertSnapshot)
+                    dom.revertToSnapshot(snapshot)
+                    self.invalidate_snapshots(id)
+                    return "Sucessfully reverted " + revertSnapshot
+                state = self.get_vm_status(dom).get("state")
+                if state == 3:
+                    dom.resume()
+                    return "VM sucessfully resumed"
+                elif state == 5:
+                    dom.create()
+                    return "VM sucessfully restarted"
+                elif state == 1:
+                    raise ResourceAlreadyRunning()
+            except libvirtError as e:
+                raise APIError(str(e))            
+    
+    def stop_vm(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                state = self.get_vm_status(dom).get("state")
+                if state == 1:
+                    dom.suspend()
+                    return "VM sucessfully stopped"
+                else:
+                    raise ResourceNotRunning()
+            except libvirtError as e:
+                raise APIError(str(e))
             
     def reboot_vm(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            state = self.get_vm_status(dom).get("state")
-            if state == 1:
-                dom.reboot()
-                return "VM sucessfully rebooted"
-            else:
-                raise ResourceNotRunning()
-        except libvirtError as e:
-            raise APIError(str(e))
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                state = self.get_vm_status(dom).get("state")
+                if state == 1:
+                    dom.reboot()
+                    return "VM sucessfully rebooted"
+                else:
+                    raise ResourceNotRunning()
+            except libvirtError as e:
+                raise APIError(str(e))
             
     def shutdown_vm(self, id, save, force):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            state = self.get_vm_status(dom).get("state")      
-            if state == 1:
-                if save:
-                    dom.managedSave()
-                    return "VM sucessfully saved"
-                elif force:
-                    dom.destroy()
-                    return "VM was forced to shutdown"
-                else:    
-                    dom.shutdown()
-                    return "VM sucessfully shutdown"
-            else:
-                raise ResourceNotRunning()                    
-        except libvirtError as e:
-            raise APIError(str(e))  
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                state = self.get_vm_status(dom).get("state")      
+                if state == 1:
+                    if save:
+                        dom.managedSave()
+                        return "VM sucessfully saved"
+                    elif force:
+                        dom.destroy()
+                        return "VM was forced to shutdown"
+                    else:    
+                        dom.shutdown()
+                        return "VM sucessfully shutdown"
+                else:
+                    raise ResourceNotRunning()                    
+            except libvirtError as e:
+                raise APIError(str(e))  
 
     def delete_vm(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            state = self.get_vm_status(dom).get("state")      
-            if state != 1:
-                dom.undefine()
-                return "Requested Ressource was sucessfully deleted"
-            else:
-                raise ResourceRunning()
-        except libvirtError as e:
-            raise APIError(str(e))
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                state = self.get_vm_status(dom).get("state")      
+                if state != 1:
+                    dom.undefine()
+                    self.forget_snapshots(id)
+                    return "Requested Ressource was sucessfully deleted"
+                else:
+                    raise ResourceRunning()
+            except libvirtError as e:
+                raise APIError(str(e))
     
     def delete_snapshot(self, id, name):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            snapshot = dom.snapshotLookupByName(name)
-            snapshot.delete()
-            return "Snapshot " + name + " sucessfully deleted"
-        except libvirtError as e:
-            raise APIError(str(e))
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                snapshot = dom.snapshotLookupByName(name)
+                snapshot.delete()
+                self.invalidate_snapshots(id, name)
+                return "Snapshot " + name + " sucessfully deleted"
+            except libvirtError as e:
+                raise APIError(str(e))
     
     def delete_storage_vol(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            pool = conn.storagePoolLookupByName("default")
-            if pool == None:
-                raise APIError("Failed to locate any StoragePool objects.")
-            state = self.get_vm_status(dom).get("state")      
-            if state != 1:
-                stgvol = pool.storageVolLookupByName(dom.name()+".qcow2")
-                stgvol.delete()
-                return "Storage volume sucessfully created"
-            else:
-                raise ResourceRunning()
-        except libvirtError as e:
-            raise APIError(str(e))          
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                pool = conn.storagePoolLookupByName("default")
+                if pool == None:
+                    raise APIError("Failed to locate any StoragePool objects.")
+                state = self.get_vm_status(dom).get("state")      
+                if state != 1:
+                    stgvol = pool.storageVolLookupByName(dom.name()+".qcow2")
+                    stgvol.delete()
+                    try:
+                        pool.storageVolLookupByName(dom.name()+"-seed.iso").delete()
+                    except libvirtError:
+                        pass
+                    self.invalidate_storage("default")
+                    return "Storage volume sucessfully created"
+                else:
+                    raise ResourceRunning()
+            except libvirtError as e:
+                raise APIError(str(e))          
         
     def run_vm_xml(self, body):
-        conn = self.libvirt_connect()
-        xmlconfig = xml.dom.minidom.parseString(body)
-        new_xml = xmlconfig.toprettyxml()
-        try:
-            dom = conn.defineXMLFlags(new_xml, 0)
-            dom.create()
-            return {"Following guest sucessfully booted": {"Id" : dom.UUIDString(), "Name": dom.name()},
-                    "info": "For further parameters visit: https://libvirt.org/formatdomain.html"}
-        except libvirtError as e:
-            raise APIError(str(e))
-
-    def run_vm_json(self, obj: BaseModel):
-        conn = self.libvirt_connect()
-        dict = obj.dict() 
-        xmlconfig = f"""
-            <domain type='kvm'>
-            ​   <name>{dict.get("name")}</name>
-            ​   <memory>{dict.get("memory")}</memory>
-            ​   <vcpu>{dict.get("vcpu")}</vcpu>
-            ​   <os>
-            ​       <type>hvm</type>             
-​                   <boot dev='hd'/>
-                   <boot dev='cdrom'/>
-               </os>
-            ​   <clock offset='utc'/>
-            ​   <on_poweroff>destroy</on_poweroff>
-            ​   <on_reboot>restart</on_reboot>
-            ​   <on_crash>destroy</on_crash>
-            ​   <devices>
-            ​       <emulator>/usr/bin/qemu-system-x86_64</emulator>
-            ​       <disk type='file' device='cdrom'>
-            ​          <source file='{dict.get("source_file")}'/>
-            ​          <driver name='qemu' type='raw'/>          
-            ​          <target dev='hda'/>
-            ​        </disk>
-                    <disk type='file' device='disk'>
-                      <driver name='qemu' type='qcow2'/>
-                      <source file='/var/lib/libvirt/images/{dict.get("name")}.qcow2'/>
-                      <target dev='vda'/>
-                    </disk>
-                    <interface type='network'>
-                        <source network='default'/>
-                    </interface>
-            ​        <input type='mouse' bus='ps2'/>
-            ​        <graphics type='vnc' port='-1' listen='127.0.0.1'/>
-            ​    </devices>
-            ​</domain>"""
-        try:
-            dom = conn.defineXMLFlags(xmlconfig, 0)
-            dom.create()
-            if dom:
+        # The body goes to libvirt unchanged, it is validated either against the
+        # cached local schema or by libvirt itself
+        flags = 0 if validate(body, "domain") else VALIDATE_FLAG
+        with self.libvirt_connect() as conn:
+            try:
+                dom = conn.defineXMLFlags(body.decode() if isinstance(body, bytes) else body, flags)
+                dom.create()
                 return {"Following guest sucessfully booted": {"Id" : dom.UUIDString(), "Name": dom.name()},
                         "info": "For further parameters visit: https://libvirt.org/formatdomain.html"}
-        except libvirtError as e:
-            raise APIError(str(e))
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def run_vm_json(self, obj: BaseModel):
+        dict = obj.dict()
+        seed = IMAGE_DIR + "/" + dict.get("name") + "-seed.iso" if dict.get("cloud_init") else None
+        xmlconfig = to_string(build_domain(dict.get("name"), dict.get("memory"), dict.get("vcpu"),
+                                           dict.get("source_file"), seed_path=seed))
+        with self.libvirt_connect() as conn:
+            try:
+                dom = conn.defineXMLFlags(xmlconfig, 0)
+                dom.create()
+                if dom:
+                    return {"Following guest sucessfully booted": {"Id" : dom.UUIDString(), "Name": dom.name()},
+                            "info": "For further parameters visit: https://libvirt.org/formatdomain.html"}
+            except libvirtError as e:
+                raise APIError(str(e))
 
     def create_snapshot(self, id, snapshot_name):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        xmlconfig = f"""
-            <domainsnapshot>
-                <name>{snapshot_name}</name>
-            </domainsnapshot>"""
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                dom.snapshotCreateXML(
+                    to_string(build_snapshot(snapshot_name)),
+                    libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+                )
+                self.invalidate_snapshots(id, snapshot_name)
+                return "Snaphot of " + dom.name() + " was sucessfully created"
+            except libvirtError as e:
+                raise APIError(str(e))  
+
+    def create_storage_vol(self, name, disk_size=None, template=None, full_clone=False):
+        capacity = disk_size * GIB if disk_size else 0
+        with self.libvirt_connect() as conn:
+            try:
+                pool = conn.storagePoolLookupByName("default")
+                if template is None:
+                    xmlconfig = to_string(build_volume(name + ".qcow2", "/var/lib/virt/images/" + name + ".qcow2",
+                                                       capacity))
+                    pool.createXML(xmlconfig, 0)
+                else:
+                    base = self.get_template(template, conn)
+                    path, format = self.get_volume_format(base)
+                    capacity = capacity or base.info()[1]
+                    if capacity < base.info()[1]:
+                        raise ArgumentNotFound("disk_size is smaller than template " + template)
+                    if full_clone:
+                        xmlconfig = to_string(build_volume(name + ".qcow2", IMAGE_DIR + "/" + name + ".qcow2",
+                                                           capacity))
+                        pool.createXMLFrom(xmlconfig, base, 0)
+                    else:
+                        # Creating an overlay does not copy data, so it takes constant time
+                        xmlconfig = to_string(build_volume(name + ".qcow2", IMAGE_DIR + "/" + name + ".qcow2",
+                                                           capacity, backing_path=path, backing_format=format))
+                        pool.createXML(xmlconfig, 0)
+                self.invalidate_storage("default")
+                return "Storage volume sucessfully created "
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def create_seed_vol(self, name, cloud_init):
+        data = build_seed_iso(name, cloud_init.user_data, cloud_init.meta_data, cloud_init.network_config)
+        with self.libvirt_connect() as conn:
+            try:
+                pool = conn.storagePoolLookupByName("default")
+                stgvol = pool.createXML(to_string(build_volume(name + "-seed.iso", IMAGE_DIR + "/" + name + "-seed.iso",
+                                                               len(data), format="raw")), 0)
+                stream = conn.newStream(0)
+                stgvol.upload(stream, 0, len(data), 0)
+                try:
+                    for offset in range(0, len(data), UPLOAD_CHUNK):
+                        stream.send(data[offset:offset + UPLOAD_CHUNK])
+                    stream.finish()
+                except libvirtError:
+                    stream.abort()
+                    raise
+                self.invalidate_storage("default")
+                return "Seed volume sucessfully created"
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def list_templates(self):
         try:
-            dom.snapshotCreateXML(
-                xmlconfig.format(snapshot_name=snapshot_name),
-                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
-            )
-            return "Snaphot of " + dom.name() + " was sucessfully created"
-        except libvirtError as e:
-            raise APIError(str(e))  
-
-    def create_storage_vol(self, name):
-        conn = self.libvirt_connect()
-        xmlconfig = f"""
-            <volume type='file'>
-                <name>{name}.qcow2</name>
-                <allocation>0</allocation>
-                <capacity>0</capacity>
-                <target>
-                    <path>/var/lib/virt/images/{name}.qcow2</path>
-                    <format type='qcow2'/>
-                    <permissions>
-                        <owner>107</owner>
-                        <group>107</group>
-                        <mode>0744</mode>
-                        <label>vir_image_t</label>
-                    </permissions>
-                </target>
-            </volume>"""
+            return self.get_pool_volumes(TEMPLATE_POOL)
+        except APIError:
+            raise ArgumentNotFound("Template pool " + TEMPLATE_POOL + " not found")
+
+    def get_template(self, name, conn):
         try:
-            pool = conn.storagePoolLookupByName("default")
-            stgvol = pool.createXML(xmlconfig, 0)
-            return "Storage volume sucessfully created "
-        except libvirtError as e:
-            raise APIError(str(e))
+            pool = conn.storagePoolLookupByName(TEMPLATE_POOL)
+        except libvirtError:
+            raise ArgumentNotFound("Template pool " + TEMPLATE_POOL + " not found")
+        for candidate in (name, name + ".qcow2"):
+            try:
+                return pool.storageVolLookupByName(candidate)
+            except libvirtError:
+                pass
+        raise ArgumentNotFound("Unknown template " + name)
+
+    def get_volume_format(self, stgvol):
+        desc = etree.fromstring(stgvol.XMLDesc(0))
+        format = desc.find("target/format")
+        return desc.findtext("target/path"), format.get("type") if format is not None else "raw"
         
     def libvirt_connect(self):
-        try:
-            conn = libvirt.open('qemu:///system')
-            return conn
-        except libvirt.libvirtError:
-            raise ConnectionFailed()
+        return self.pool.connection()
     
-    def get_vm(self, id):
-        conn = self.libvirt_connect()
+    def get_vm(self, id, conn=None):
+        if conn is None:
+            with self.libvirt_connect() as conn:
+                return self.get_vm(id, conn)
         try:
             return conn.lookupByUUIDString(id)
         except libvirtError:
             raise ResourceNotFound()
     
-    def get_vm_snapshots(self, id):
-        conn = self.libvirt_connect()
-        dom = self.get_vm(id)
-        try:
-            return dom.listAllSnapshots()
-        except libvirtError as e:
-            raise APIError(e.args[0])
+    def get_job_progress(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                stats = dom.jobStats()
+            except libvirtError as e:
+                raise APIError(str(e))
+            if stats.get("type", libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+                return None
+            total = stats.get("data_total") or stats.get("memory_total") or 0
+            processed = stats.get("data_processed") or stats.get("memory_processed") or 0
+            return {"elapsed": stats.get("time_elapsed"),
+                    "current": processed,
+                    "total": total,
+                    "percent": round(processed * 100 / total, 1) if total else None}
+
+    def abort_job(self, id):
+        with self.libvirt_connect() as conn:
+            dom = self.get_vm(id, conn)
+            try:
+                dom.abortJob()
+                return "Job of " + dom.name() + " aborted"
+            except libvirtError as e:
+                raise APIError(str(e))
+
+    def list_vm_ids(self):
+        with self.libvirt_connect() as conn:
+            try:
+                return [(dom.UUIDString(), dom.name(), domain_title(dom)) for dom in conn.listAllDomains()]
+            except libvirtError as e:
+                raise APIError(str(e))
+    
+    def get_vm_title(self, id):
+        with self.libvirt_connect() as conn:
+            return domain_title(self.get_vm(id, conn))
+
+    def pool_stats(self):
+        return self.pool.stats()
 
     def get_vm_status(self, dom):
         state, maxmem, mem, cpus, cput = dom.info()
-        str = ""
-        if state == 1:
-            str = "Running"
-        elif state == 3:
-            str = "Stopped(Paused)"
-        elif state == 5:
-            str = "Not Running"
         return {"state": state,
-                "desc": str}
+                "desc": STATUS_DESC.get(state, "")}
+
+    def build_vm_summary(self, dom, record, persistent, groups=()):
+        state = record.get("state.state")
+        entry = {"uuid": dom.UUIDString(),
+                 "name": dom.name(),
+                 "isActive": int(state != libvirt.VIR_DOMAIN_SHUTOFF),
+                 "status": STATUS_DESC.get(state, ""),
+                 "isPersistent": int(bool(persistent))}
+        if groups:
+            entry["stats"] = {group: self.get_stats_group(record, group) for group in groups}
+        return entry
+
+    def parse_stats_groups(self, stats):
+        if not stats:
+            return []
+        groups = [group.strip() for group in stats.split(",") if group.strip()]
+        for group in groups:
+            if group not in STATS_GROUPS:
+                raise ArgumentNotFound("Unknown stats group " + group)
+        return groups
+
+    def get_stats_group(self, record, group):
+        prefix = group + "."
+        return {key[len(prefix):]: value for key, value in record.items() if key.startswith(prefix)}
@@ -0,0 +1,293 @@
+import queue
+import time
+import uuid
+from docker import errors
+
+# In-process stand-in for the docker-py client surface used by Docker and
+# Inventory. Every call that is an HTTP request to dockerd sleeps LATENCY.
+
+LATENCY = 0.0
+LOG_LINES = 5
+LOG_INTERVAL = 0.1
+
+def request():
+    if LATENCY:
+        time.sleep(LATENCY)
+
+class Container():
+    def __init__(self, client, image, name, status="exited"):
+        self.client = client
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.name = name
+        self.image = image
+        self.status = status
+        self.labels = {}
+
+    @property
+    def short_id(self):
+        return self.id[:12]
+
+    @property
+    def attrs(self):
+        return {"Id": self.id,
+                "Name": "/" + self.name,
+                "Created": "2024-01-01T00:00:00Z",
+                "Config": {"Image": self.image, "Env": [], "Labels": self.labels},
+                "State": {"Status": self.status, "Running": self.status == "running"},
+                "NetworkSettings": {"IPAddress": "172.17.0.2"}}
+
+    def summary(self):
+        image = self.client.find_image(self.image)
+        return {"Id": self.id, "Names": ["/" + self.name], "Image": self.image,
+                "ImageID": image.id if image is not None else None, "State": self.status,
+                "Status": "Up" if self.status == "running" else "Exited (0)", "Labels": self.labels,
+                "Created": 1700000000}
+
+    def reload(self):
+        request()
+
+    def start(self):
+        request()
+        self.status = "running"
+
+    def stop(self, **kwargs):
+        request()
+        self.status = "exited"
+
+    def restart(self, **kwargs):
+        request()
+        self.status = "running"
+
+    def rename(self, name):
+        request()
+        if name in self.client.names:
+            raise errors.APIError("Conflict. The container name \"/" + name + "\" is already in use")
+        self.client.names.pop(self.name, None)
+        self.name = name
+        self.client.names[name] = self
+
+    def remove(self, **kwargs):
+        request()
+        self.client.store.pop(self.id, None)
+        self.client.names.pop(self.name, None)
+
+    def logs(self, stream=False, follow=False, tail="all", timestamps=False, **kwargs):
+        request()
+        lines = ["line " + str(i) for i in range(LOG_LINES)]
+        if tail != "all":
+            lines = lines[len(lines) - tail:] if tail else []
+        chunks = LogStream(lines, follow and self.status == "running", timestamps)
+        return chunks if stream else b"".join(chunks)
+
+class LogStream():
+    # Stands in for docker-py's CancellableStream, a followed stream emits a line per LOG_INTERVAL
+    def __init__(self, lines, follow, timestamps):
+        self.lines = iter(lines)
+        self.follow = follow
+        self.timestamps = timestamps
+        self.closed = False
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines, None)
+        if line is None:
+            if not self.follow:
+                raise StopIteration
+            time.sleep(LOG_INTERVAL)
+            self.count += 1
+            line = "live " + str(self.count)
+        if self.closed:
+            raise StopIteration
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z ") if self.timestamps else ""
+        return (prefix + line + "\n").encode()
+
+    def close(self):
+        self.closed = True
+
+class ContainerCollection():
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, all=False, **kwargs):
+        request()
+        return list(self.client.store.values())
+
+    def get(self, id):
+        request()
+        container = self.client.find_container(id)
+        if container is None:
+            raise errors.NotFound("No such container: " + id)
+        return container
+
+    def create(self, image, name=None, labels=None, **kwargs):
+        request()
+        container = self.client.add_container(image, name or "c" + uuid.uuid4().hex[:8], "created")
+        container.labels = dict(labels or {})
+        return container
+
+    def run(self, image, name=None, **kwargs):
+        container = self.create(image, name)
+        container.start()
+        return container
+
+    def prune(self, **kwargs):
+        request()
+        removed = [id for id, container in self.client.store.items() if container.status != "running"]
+        for id in removed:
+            self.client.names.pop(self.client.store.pop(id).name, None)
+        return {"ContainersDeleted": removed, "SpaceReclaimed": 0}
+
+class Image():
+    def __init__(self, tag):
+        self.id = "sha256:" + uuid.uuid4().hex + uuid.uuid4().hex
+        self.tags = [tag]
+
+    @property
+    def attrs(self):
+        return {"Id": self.id, "RepoTags": self.tags, "Created": "2024-01-01T00:00:00Z", "Size": 1000000}
+
+    def summary(self):
+        return {"Id": self.id, "RepoTags": self.tags, "Created": 1700000000, "Size": 1000000,
+                "Containers": -1}
+
+class ImageCollection():
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, all=False, **kwargs):
+        request()
+        return list(self.client.image_list)
+
+    def get(self, name):
+        request()
+        image = self.client.find_image(name)
+        if image is None:
+            raise errors.ImageNotFound("No such image: " + name)
+        return image
+
+class APIClient():
+    def __init__(self, client):
+        self.client = client
+
+    def containers(self, all=False, filters=None, limit=-1, **kwargs):
+        request()
+        containers = list(self.client.store.values())
+        filters = filters or {}
+        if "id" in filters:
+            containers = [container for container in containers if container.id.startswith(filters["id"])]
+        if "label" in filters:
+            key, _, value = filters["label"].partition("=")
+            containers = [container for container in containers if container.labels.get(key) == value]
+        if "status" in filters:
+            containers = [container for container in containers if container.status == filters["status"]]
+        if limit and limit > 0:
+            containers = containers[:limit]
+        return [container.summary() for container in containers]
+
+    def images(self, all=False, filters=None, **kwargs):
+        request()
+        return [image.summary() for image in self.client.image_list]
+
+    def inspect_container(self, id):
+        return self.client.containers.get(id).attrs
+
+    def inspect_image(self, name):
+        return self.client.images.get(name).attrs
+
+    def remove_image(self, image, force=False, noprune=False):
+        request()
+        found = self.client.find_image(image)
+        if found is None:
+            raise errors.ImageNotFound("No such image: " + image)
+        self.client.image_list.remove(found)
+
+    def stats(self, container, stream=True, decode=False, **kwargs):
+        found = self.client.find_container(container)
+        if found is None:
+            raise errors.NotFound("No such container: " + container)
+
+        def frames():
+            usage = 0
+            while found.id in self.client.store:
+                request()
+                usage += 10000000
+                yield {"read": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                       "cpu_stats": {"cpu_usage": {"total_usage": usage}, "system_cpu_usage": usage * 4,
+                                     "online_cpus": 2},
+                       "precpu_stats": {"cpu_usage": {"total_usage": usage - 10000000},
+                                        "system_cpu_usage": (usage - 10000000) * 4},
+                       "memory_stats": {"usage": 50000000, "limit": 1000000000, "stats": {"inactive_file": 1000000}},
+                       "blkio_stats": {"io_service_bytes_recursive": [{"op": "read", "value": usage // 1000},
+                                                                      {"op": "write", "value": usage // 2000}]},
+                       "networks": {"eth0": {"rx_bytes": usage // 100, "tx_bytes": usage // 200}}}
+                time.sleep(1)
+        return frames() if stream else next(frames())
+
+    def pull(self, repository, tag=None, stream=False, decode=False, **kwargs):
+        request()
+        self.client.image_list.append(Image(repository + ":" + (tag or "latest")))
+        events = [{"status": "Pulling from " + repository},
+                  {"status": "Downloading", "id": "layer", "progressDetail": {"current": 1, "total": 1}},
+                  {"status": "Status: Downloaded newer image"}]
+        return iter(events) if stream else ""
+
+class EventStream():
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.queue.get()
+        if event is None:
+            raise StopIteration
+        return event
+
+    def close(self):
+        self.queue.put(None)
+
+class DockerClient():
+    def __init__(self, containers=0, images=1, running=0.5):
+        self.store = {}
+        self.names = {}
+        self.image_list = [Image("image" + str(i) + ":latest") for i in range(max(images, 1))]
+        self.containers = ContainerCollection(self)
+        self.images = ImageCollection(self)
+        self.api = APIClient(self)
+        for i in range(containers):
+            self.add_container(self.image_list[i % len(self.image_list)].tags[0], "c" + str(i),
+                               "running" if i < containers * running else "exited")
+
+    def add_container(self, image, name, status="exited"):
+        container = Container(self, image, name, status)
+        self.store[container.id] = container
+        self.names[name] = container
+        return container
+
+    def find_container(self, id):
+        container = self.store.get(id) or self.names.get(id)
+        if container is not None:
+            return container
+        for container in self.store.values():
+            if container.id.startswith(id):
+                return container
+        return None
+
+    def find_image(self, name):
+        for image in self.image_list:
+            if name in image.tags or image.id.startswith(name) or name + ":latest" in image.tags:
+                return image
+        return None
+
+    def events(self, decode=False, **kwargs):
+        return EventStream()
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
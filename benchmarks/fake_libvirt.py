@@ -0,0 +1,452 @@
+import time
+import uuid
+from lxml import etree
+
+# In-process stand-in for the parts of libvirt-python used by VM, Connection
+# and Inventory. Every call that is an RPC on a real connection sleeps LATENCY.
+
+LATENCY = 0.0
+
+VIR_ERR_SYSTEM_ERROR = 38
+VIR_ERR_NO_DOMAIN = 42
+VIR_ERR_NO_STORAGE_POOL = 49
+VIR_ERR_NO_STORAGE_VOL = 50
+VIR_ERR_NO_DOMAIN_SNAPSHOT = 72
+
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_PAUSED = 3
+VIR_DOMAIN_SHUTOFF = 5
+
+VIR_DOMAIN_STATS_STATE = 1
+VIR_DOMAIN_STATS_CPU_TOTAL = 2
+VIR_DOMAIN_STATS_BALLOON = 4
+VIR_DOMAIN_STATS_VCPU = 8
+VIR_DOMAIN_STATS_INTERFACE = 16
+VIR_DOMAIN_STATS_BLOCK = 32
+
+VIR_CONNECT_LIST_DOMAINS_PERSISTENT = 4
+VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE = 2
+VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = 1
+VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC = 128
+VIR_DOMAIN_DEFINE_VALIDATE = 1
+VIR_DOMAIN_JOB_NONE = 0
+VIR_DOMAIN_METADATA_TITLE = 1
+VIR_DOMAIN_AFFECT_CONFIG = 2
+VIR_DOMAIN_CONSOLE_SAFE = 2
+CONSOLE_INTERVAL = 0.1
+
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_DEFINED = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE = 0
+VIR_STORAGE_POOL_EVENT_ID_REFRESH = 1
+
+class libvirtError(Exception):
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+def rpc():
+    if LATENCY:
+        time.sleep(LATENCY)
+
+def virEventRegisterDefaultImpl():
+    pass
+
+def virEventRunDefaultImpl():
+    time.sleep(1)
+
+class Snapshot():
+    def __init__(self, domain, name, parent=None):
+        self.domain = domain
+        self.name = name
+        self.parent = parent
+        self.created = int(time.time())
+
+    def getName(self):
+        return self.name
+
+    def getXMLDesc(self, flags=0):
+        rpc()
+        parent = "<parent><name>" + self.parent + "</name></parent>" if self.parent else ""
+        return ("<domainsnapshot><name>" + self.name + "</name><state>running</state>" + parent +
+                "<creationTime>" + str(self.created) + "</creationTime><memory snapshot='internal'/>" +
+                self.domain.XMLDesc() + "</domainsnapshot>")
+
+    def isCurrent(self, flags=0):
+        rpc()
+        return int(self.domain.current == self.name)
+
+    def delete(self, flags=0):
+        rpc()
+        del self.domain.snapshots[self.name]
+        if self.domain.current == self.name:
+            self.domain.current = self.parent
+
+class Domain():
+    def __init__(self, name, state=VIR_DOMAIN_SHUTOFF, uuid_string=None):
+        self._name = name
+        self._uuid = uuid_string or str(uuid.uuid4())
+        self.state = state
+        self.persistent = 1
+        self.snapshots = {}
+        self.current = None
+        self.saved = False
+        self.title = None
+        self.console_open = False
+
+    def UUIDString(self):
+        return self._uuid
+
+    def name(self):
+        return self._name
+
+    def isActive(self):
+        rpc()
+        return int(self.state != VIR_DOMAIN_SHUTOFF)
+
+    def isPersistent(self):
+        rpc()
+        return self.persistent
+
+    def info(self):
+        rpc()
+        return [self.state, 1048576, 1048576, 1, 1000000]
+
+    def OSType(self):
+        rpc()
+        return "hvm"
+
+    def XMLDesc(self, flags=0):
+        return ("<domain type='kvm'><name>" + self._name + "</name><uuid>" + self._uuid + "</uuid>"
+                "<memory unit='KiB'>1048576</memory><vcpu>1</vcpu><os><type>hvm</type></os>"
+                "<devices><disk type='file' device='disk'><source file='/var/lib/libvirt/images/" +
+                self._name + ".qcow2'/><target dev='vda'/></disk></devices></domain>")
+
+    def hasCurrentSnapshot(self, flags=0):
+        rpc()
+        return int(self.current is not None)
+
+    def jobStats(self, flags=0):
+        rpc()
+        return {"type": VIR_DOMAIN_JOB_NONE}
+
+    def abortJob(self):
+        rpc()
+
+    def create(self):
+        rpc()
+        self.state = VIR_DOMAIN_RUNNING
+        self.saved = False
+
+    def resume(self):
+        rpc()
+        self.state = VIR_DOMAIN_RUNNING
+
+    def suspend(self):
+        rpc()
+        self.state = VIR_DOMAIN_PAUSED
+
+    def reboot(self, flags=0):
+        rpc()
+
+    def shutdown(self):
+        rpc()
+        self.state = VIR_DOMAIN_SHUTOFF
+
+    def destroy(self):
+        rpc()
+        self.state = VIR_DOMAIN_SHUTOFF
+
+    def managedSave(self, flags=0):
+        rpc()
+        self.state = VIR_DOMAIN_SHUTOFF
+        self.saved = True
+
+    def hasManagedSaveImage(self, flags=0):
+        rpc()
+        return int(self.saved)
+
+    def openConsole(self, dev_name, stream, flags=0):
+        rpc()
+        if self.state != VIR_DOMAIN_RUNNING:
+            raise libvirtError("domain is not running")
+        if self.console_open and flags & VIR_DOMAIN_CONSOLE_SAFE:
+            raise libvirtError("Active console session exists for this domain")
+        self.console_open = True
+        stream.console = self._name
+        stream.domain = self
+
+    def metadata(self, type, uri, flags=0):
+        rpc()
+        if type == VIR_DOMAIN_METADATA_TITLE and self.title is not None:
+            return self.title
+        raise libvirtError("metadata not found")
+
+    def setMetadata(self, type, metadata, key, uri, flags=0):
+        rpc()
+        if type == VIR_DOMAIN_METADATA_TITLE:
+            self.title = metadata
+
+    def undefine(self):
+        rpc()
+        driver.domains.pop(self._uuid, None)
+
+    def listAllSnapshots(self, flags=0):
+        rpc()
+        return list(self.snapshots.values())
+
+    def snapshotNum(self, flags=0):
+        rpc()
+        return len(self.snapshots)
+
+    def snapshotLookupByName(self, name, flags=0):
+        rpc()
+        if name not in self.snapshots:
+            raise libvirtError("Domain snapshot not found: " + name, VIR_ERR_NO_DOMAIN_SNAPSHOT)
+        return self.snapshots[name]
+
+    def snapshotCurrent(self, flags=0):
+        rpc()
+        if self.current is None:
+            raise libvirtError("Domain has no current snapshot", VIR_ERR_NO_DOMAIN_SNAPSHOT)
+        return self.snapshots[self.current]
+
+    def snapshotCreateXML(self, xml, flags=0):
+        rpc()
+        name = etree.fromstring(xml).findtext("name")
+        self.snapshots[name] = Snapshot(self, name, self.current)
+        self.current = name
+        return self.snapshots[name]
+
+    def revertToSnapshot(self, snapshot, flags=0):
+        rpc()
+        self.current = snapshot.name
+
+class Volume():
+    def __init__(self, pool, name, capacity=0, format="qcow2"):
+        self.pool = pool
+        self._name = name
+        self.capacity = capacity
+        self.format = format
+
+    def name(self):
+        return self._name
+
+    def key(self):
+        return self.pool.target + "/" + self._name
+
+    def path(self):
+        rpc()
+        return self.key()
+
+    def info(self):
+        rpc()
+        return [0, self.capacity, 0]
+
+    def XMLDesc(self, flags=0):
+        rpc()
+        return ("<volume type='file'><name>" + self._name + "</name><capacity>" + str(self.capacity) +
+                "</capacity><target><path>" + self.key() + "</path><format type='" + self.format +
+                "'/></target></volume>")
+
+    def upload(self, stream, offset, length, flags=0):
+        rpc()
+
+    def delete(self, flags=0):
+        rpc()
+        self.pool.volumes.pop(self._name, None)
+
+class StoragePool():
+    def __init__(self, name, target):
+        self._name = name
+        self.target = target
+        self.volumes = {}
+
+    def name(self):
+        return self._name
+
+    def XMLDesc(self, flags=0):
+        rpc()
+        return ("<pool type='dir'><name>" + self._name + "</name><target><path>" + self.target +
+                "</path></target></pool>")
+
+    def isActive(self):
+        return 1
+
+    def refresh(self, flags=0):
+        rpc()
+
+    def listAllVolumes(self, flags=0):
+        rpc()
+        return list(self.volumes.values())
+
+    def storageVolLookupByName(self, name):
+        rpc()
+        if name not in self.volumes:
+            raise libvirtError("Storage volume not found: " + name, VIR_ERR_NO_STORAGE_VOL)
+        return self.volumes[name]
+
+    def createXML(self, xml, flags=0):
+        rpc()
+        config = etree.fromstring(xml)
+        name = config.findtext("name")
+        format = config.find("target/format")
+        self.volumes[name] = Volume(self, name, int(config.findtext("capacity") or 0),
+                                    format.get("type") if format is not None else "raw")
+        return self.volumes[name]
+
+    def createXMLFrom(self, xml, source, flags=0):
+        return self.createXML(xml, flags)
+
+class Stream():
+    def __init__(self):
+        self.console = None
+        self.aborted = False
+        self.count = 0
+
+    def send(self, data):
+        rpc()
+        return len(data)
+
+    def recv(self, nbytes):
+        # Console output: one line per CONSOLE_INTERVAL until aborted
+        if self.console is None:
+            raise libvirtError("stream is not open")
+        time.sleep(CONSOLE_INTERVAL)
+        if self.aborted:
+            raise libvirtError("stream aborted")
+        self.count += 1
+        return (self.console + " login: " + str(self.count) + "\r\n").encode()[:nbytes]
+
+    def finish(self):
+        rpc()
+
+    def abort(self):
+        self.aborted = True
+        if self.console is not None:
+            self.domain.console_open = False
+
+class Driver():
+    def __init__(self):
+        self.populate()
+
+    def populate(self, domains=0, volumes=0, snapshots=0, running=0.5):
+        self.domains = {}
+        self.pools = {"default": StoragePool("default", "/var/lib/libvirt/images"),
+                      "templates": StoragePool("templates", "/var/lib/libvirt/templates")}
+        templates = self.pools["templates"]
+        templates.volumes["debian12.qcow2"] = Volume(templates, "debian12.qcow2", 10737418240)
+        for i in range(domains):
+            state = VIR_DOMAIN_RUNNING if i < domains * running else VIR_DOMAIN_SHUTOFF
+            domain = Domain("vm" + str(i), state)
+            for j in range(snapshots):
+                domain.snapshotCreateXML("<domainsnapshot><name>s" + str(j) + "</name></domainsnapshot>")
+            self.domains[domain.UUIDString()] = domain
+        pool = self.pools["default"]
+        for i in range(volumes):
+            name = "vm" + str(i) + ".qcow2"
+            pool.volumes[name] = Volume(pool, name, 10737418240)
+
+driver = Driver()
+
+class Connection():
+    def __init__(self, uri):
+        self.uri = uri
+        self.alive = 1
+
+    def isAlive(self):
+        return self.alive
+
+    def close(self):
+        self.alive = 0
+        return 0
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+    def registerCloseCallback(self, callback, opaque):
+        pass
+
+    def unregisterCloseCallback(self):
+        pass
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        return 1
+
+    def domainEventDeregisterAny(self, callback_id):
+        pass
+
+    def storagePoolEventRegisterAny(self, pool, event_id, callback, opaque):
+        return 2
+
+    def storagePoolEventDeregisterAny(self, callback_id):
+        pass
+
+    def listAllDomains(self, flags=0):
+        rpc()
+        return list(driver.domains.values())
+
+    def lookupByUUIDString(self, uuid_string):
+        rpc()
+        if uuid_string not in driver.domains:
+            raise libvirtError("Domain not found: " + uuid_string, VIR_ERR_NO_DOMAIN)
+        return driver.domains[uuid_string]
+
+    def lookupByName(self, name):
+        rpc()
+        for domain in driver.domains.values():
+            if domain.name() == name:
+                return domain
+        raise libvirtError("Domain not found: " + name, VIR_ERR_NO_DOMAIN)
+
+    def defineXMLFlags(self, xml, flags=0):
+        rpc()
+        config = etree.fromstring(xml.encode() if isinstance(xml, str) else xml)
+        domain = Domain(config.findtext("name"), uuid_string=config.findtext("uuid"))
+        driver.domains[domain.UUIDString()] = domain
+        return domain
+
+    def defineXML(self, xml):
+        return self.defineXMLFlags(xml)
+
+    def getAllDomainStats(self, stats=0, flags=0):
+        return self.domainListGetStats(list(driver.domains.values()), stats, flags)
+
+    def domainListGetStats(self, doms, stats=0, flags=0):
+        rpc()
+        records = []
+        for domain in doms:
+            record = {"state.state": domain.state, "state.reason": 1}
+            if stats & VIR_DOMAIN_STATS_CPU_TOTAL:
+                record.update({"cpu.time": time.monotonic_ns(), "cpu.user": 1, "cpu.system": 1})
+            if stats & VIR_DOMAIN_STATS_BALLOON:
+                record.update({"balloon.current": 1048576, "balloon.maximum": 1048576})
+            if stats & VIR_DOMAIN_STATS_BLOCK:
+                record.update({"block.count": 1, "block.0.name": "vda",
+                               "block.0.rd.bytes": 0, "block.0.wr.bytes": 0})
+            if stats & VIR_DOMAIN_STATS_INTERFACE:
+                record.update({"net.count": 1, "net.0.name": "vnet0",
+                               "net.0.rx.bytes": 0, "net.0.tx.bytes": 0})
+            records.append((domain, record))
+        return records
+
+    def newStream(self, flags=0):
+        return Stream()
+
+    def listAllStoragePools(self, flags=0):
+        rpc()
+        return list(driver.pools.values())
+
+    def storagePoolLookupByName(self, name):
+        rpc()
+        if name not in driver.pools:
+            raise libvirtError("Storage pool not found: " + name, VIR_ERR_NO_STORAGE_POOL)
+        return driver.pools[name]
+
+def open(uri=None):
+    rpc()
+    return Connection(uri)
@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS_DIR = os.path.join(HERE, "results")
+DEFAULT_SIZES = "10,100,1000,10000"
+SNAPSHOTS_PER_VM = 3
+AUTH_REQUESTS = 20
+READY_TIMEOUT = 60
+REGRESSION_THRESHOLD = 0.2
+
+# name, method, path template, request count factor, json body; {i} is a
+# resource number, running resources are the first half of each inventory,
+# {n} counts requests
+SCENARIOS = [
+    ("users/me", "GET", "/users/me/", 1, None),
+    ("list containers", "GET", "/resources?type=containers", 1, None),
+    ("list vms", "GET", "/resources?type=vms", 1, None),
+    ("list vms with stats", "GET", "/resources?type=vms&stats=cpu,balloon", 1, None),
+    ("list volumes", "GET", "/resources?type=volumes", 1, None),
+    ("page vms", "GET", "/resources?type=vms&page_size=100", 1, None),
+    ("info container", "GET", "/resources/c{i}", 1, None),
+    ("info vm", "GET", "/resources/vm{i}", 1, None),
+    ("snapshots vm", "GET", "/resources/vm{i}/snapshots", 1, None),
+    ("restart container", "PUT", "/resources/c{running}/restart", 1, None),
+    ("restart vm", "PUT", "/resources/vm{running}/restart", 1, None),
+    ("provision from template", "POST", "/resources/kvm-qemu/run/json", 1,
+     {"name": "bench{n}", "memory": 1048576, "vcpu": 1, "template": "debian12"}),
+]
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def prepare(size, latency, libvirt_uri):
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, HERE)
+    import docker
+    import fake_docker
+    fake_docker.LATENCY = latency
+    docker.from_env = lambda **kwargs: fake_docker.DockerClient(containers=size, images=min(size, 100))
+    if libvirt_uri == "fake":
+        import fake_libvirt
+        fake_libvirt.LATENCY = latency
+        fake_libvirt.driver.populate(domains=size, volumes=size, snapshots=SNAPSHOTS_PER_VM)
+        sys.modules["libvirt"] = fake_libvirt
+    else:
+        os.environ["LIBVIRT_URI"] = libvirt_uri
+        populate_libvirt(libvirt_uri, size)
+
+def populate_libvirt(uri, size):
+    # The test driver keeps its state per process, so domains defined here
+    # are visible to the API's own connections
+    import libvirt
+    conn = libvirt.open(uri)
+    pool = conn.storagePoolLookupByName("default-pool")
+    for i in range(size):
+        dom = conn.defineXML("<domain type='test'><name>vm" + str(i) + "</name><memory>1024</memory>"
+                             "<os><type>hvm</type></os></domain>")
+        if i < size / 2:
+            dom.create()
+        for j in range(SNAPSHOTS_PER_VM):
+            dom.snapshotCreateXML("<domainsnapshot><name>s" + str(j) + "</name></domainsnapshot>")
+        pool.createXML("<volume><name>vm" + str(i) + ".qcow2</name><capacity>1073741824</capacity>"
+                       "</volume>")
+    conn.close()
+
+async def measure(client, method, path, body, size, requests, concurrency, headers):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            url = path.format(i=n % size, running=n % max(size // 2, 1))
+            payload = dict(body, name=body["name"].format(n=n)) if body else None
+            start = time.perf_counter()
+            response = await client.request(method, url, json=payload, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests": len(latencies),
+            "errors": errors,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "rps": len(latencies) / elapsed if elapsed else None}
+
+async def wait_ready(main):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while main.inventory._running and main.inventory.stats()["stale"]:
+        if time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.05)
+
+async def run_worker(args):
+    import httpx
+    prepare(args.size, args.latency, args.libvirt)
+    import main
+    transport = httpx.ASGITransport(app=main.app)
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        await wait_ready(main)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            login = {"username": "johndoe", "password": "secret", "scope": "basic advanced"}
+            start = time.perf_counter()
+            latencies = []
+            errors = 0
+            for _ in range(AUTH_REQUESTS):
+                begin = time.perf_counter()
+                response = await client.post("/token", data=login)
+                latencies.append(time.perf_counter() - begin)
+                if response.status_code != 200:
+                    errors += 1
+            elapsed = time.perf_counter() - start
+            results["auth"] = {"requests": AUTH_REQUESTS, "errors": errors,
+                               "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                               "rps": AUTH_REQUESTS / elapsed}
+            headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+            for name, method, path, factor, body in SCENARIOS:
+                if args.scenarios and name not in args.scenarios:
+                    continue
+                results[name] = await measure(client, method, path, body, args.size, args.requests * factor,
+                                              args.concurrency, headers)
+    json.dump(results, sys.stdout)
+
+def run_size(args, size):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--size", str(size),
+               "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+               "--latency", str(args.latency), "--libvirt", args.libvirt]
+    for name in args.scenarios or []:
+        command += ["--scenario", name]
+    env = dict(os.environ, INVENTORY="0" if args.no_inventory else "1")
+    output = subprocess.run(command, check=True, capture_output=True, text=True, env=env, cwd=ROOT).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def previous_run(config):
+    for path in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), reverse=True):
+        with open(path) as file:
+            run = json.load(file)
+        if run.get("config") == config:
+            return path, run
+    return None, None
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def report(results, previous, threshold):
+    regressions = []
+    print("%-8s %-22s %9s %9s %9s %6s %s" % ("size", "scenario", "p50 ms", "p99 ms", "req/s", "err", "vs last"))
+    for size, scenarios in results.items():
+        for name, result in scenarios.items():
+            change = ""
+            before = (previous or {}).get(size, {}).get(name)
+            if before and before.get("p99") and result["p99"]:
+                delta = result["p99"] / before["p99"] - 1
+                change = "%+.0f%% p99" % (delta * 100)
+                if delta > threshold:
+                    change += " REGRESSION"
+                    regressions.append((size, name))
+            print("%-8s %-22s %9.2f %9.2f %9.1f %6d %s" % (size, name, result["p50"] * 1000, result["p99"] * 1000,
+                                                          result["rps"], result["errors"], change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the Virtualization API "
+                                                 "against in-process Docker and libvirt stand-ins")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated resource counts per backend")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected seconds per backend call")
+    parser.add_argument("--libvirt", default="fake", help="fake or a libvirt URI such as test:///default")
+    parser.add_argument("--no-inventory", action="store_true", help="Run with INVENTORY=0")
+    parser.add_argument("--scenario", dest="scenarios", action="append", help="Only run this scenario")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Relative p99 increase reported as regression")
+    parser.add_argument("--no-save", action="store_true", help="Do not write the results file")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(run_worker(args))
+        return
+
+    config = {"requests": args.requests, "concurrency": args.concurrency, "latency": args.latency,
+              "libvirt": args.libvirt, "inventory": not args.no_inventory}
+    # Every size runs in its own process, so module level state starts clean
+    results = {str(size): run_size(args, int(size)) for size in args.sizes.split(",")}
+    path, previous = previous_run(config)
+    regressions = report(results, previous["results"] if previous else None, args.threshold)
+    if path:
+        print("compared with " + os.path.basename(path))
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        target = os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+        with open(target, "w") as file:
+            json.dump({"timestamp": datetime.now().isoformat(), "revision": git_revision(),
+                       "config": config, "results": results}, file, indent=2)
+        print("saved " + os.path.relpath(target, ROOT))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,131 @@
-from datetime import  timedelta
-from typing import List, Annotated
-from fastapi import Depends, FastAPI, HTTPException, Query, Request, Security, status
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import os
+import re
+import threading
+from typing import List, Literal, Annotated
+from fastapi import (
+    Depends, FastAPI, HTTPException, Query, Request, Response, Security, 
+    WebSocket, WebSocketDisconnect, WebSocketException, status
+)
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from Docker import Docker, ContainerObj
 from VM import VM, DomainObj
 from Security import (
-    User, Token, fake_users_db, 
+    User, Token, user_store, 
     authenticate_user, create_access_token,
-    get_current_active_user, ACCESS_TOKEN_EXPIRE_MINUTES
+    get_current_active_user, get_websocket_user, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from Backend import AsyncBackend, DOCKER_WORKERS, LIBVIRT_WORKERS
+from Metrics import MetricsMiddleware, instrument, registry
+from Jobs import JobManager, JOB_TIMEOUT
+from Cache import ReadCache
+from Pools import WarmPools
+from Inventory import Inventory, INVENTORY_ENABLED, KINDS
+from Listing import (
+    KEY_FIELDS, SUMMARY_FIELDS, content_etag, delta_rows, etag_matches, filter_rows, iterate, make_etag, 
+    matches, paginate, parse_fields, parse_type, peek, project, to_ndjson, DEFAULT_PAGE_SIZE
+)
+from Routing import ResourceIndex, SHORT_ID_LENGTH
+from Hosts import Host, HostRegistry, LOCAL_HOST
+from Telemetry import Telemetry
+from Logs import LogStreams
+from History import History, HISTORY_ENABLED, METRICS
 from Exceptions import (
-    APIError, ArgumentNotFound, ResourceAlreadyRunning, 
+    APIError, ArgumentNotFound, BackendTimeout, ConnectionFailed, JobLimitReached, ResourceAlreadyRunning, 
     ResourceNotFound, ResourceNotRunning, ImageNotFound, ResourceRunning
 )
 
-docker = Docker()
-vm = VM()
+MAX_BATCH_SIZE = 500
+PROGRESS_INTERVAL = 1.0
+BATCH_DOCKER_CONCURRENCY = int(os.getenv("BATCH_DOCKER_CONCURRENCY", "8"))
+BATCH_LIBVIRT_CONCURRENCY = int(os.getenv("BATCH_LIBVIRT_CONCURRENCY", "4"))
+
+docker = AsyncBackend(instrument(Docker(), "docker"), "docker", DOCKER_WORKERS)
+vm = AsyncBackend(instrument(VM(), "kvm-qemu"), "kvm-qemu", LIBVIRT_WORKERS)
+executor_queued = registry.gauge("backend_executor_queued", "Calls waiting for a backend worker thread", ("backend",))
+executor_running = registry.gauge("backend_executor_running", "Busy backend worker threads", ("backend",))
+index = ResourceIndex(docker, vm)
+hosts = HostRegistry(Host(LOCAL_HOST, docker, vm, index))
+inventory = Inventory(docker.backend, vm.backend)
+pools = WarmPools(docker.backend, vm.backend)
+telemetry = Telemetry(docker.backend, vm.backend)
+history = History(docker.backend, vm.backend)
+logs = LogStreams(docker, vm)
+cache = ReadCache()
+LIST_KINDS = {"docker": "containers", "kvm-qemu": "domains"}
+
+def update_index(kind, key, row):
+    if kind == "domains":
+        if row is None:
+            index.remove(key)
+        else:
+            # Listener runs on a watcher thread, the title of claimed warm pool guests is their requested name
+            try:
+                title = vm.backend.get_vm_title(key)
+            except (APIError, ConnectionFailed, ResourceNotFound):
+                title = None
+            index.add("kvm-qemu", key, row["name"], title)
+    elif kind == "containers":
+        if row is None:
+            index.remove(key)
+        else:
+            index.invalidate()
+
+def invalidate_cache(kind, key, row):
+    cache.invalidate((hosts.local.name, kind), (hosts.local.name, key))
+
+inventory.listeners.append(update_index)
+inventory.listeners.append(invalidate_cache)
+
+batch_limits = {"docker": asyncio.Semaphore(BATCH_DOCKER_CONCURRENCY), 
+                "kvm-qemu": asyncio.Semaphore(BATCH_LIBVIRT_CONCURRENCY)}
+
+ERROR_STATUS = {
+    APIError: status.HTTP_409_CONFLICT,
+    ResourceAlreadyRunning: status.HTTP_409_CONFLICT,
+    ResourceNotRunning: status.HTTP_409_CONFLICT,
+    ResourceRunning: status.HTTP_409_CONFLICT,
+    ResourceNotFound: status.HTTP_404_NOT_FOUND,
+    ImageNotFound: status.HTTP_404_NOT_FOUND,
+    ArgumentNotFound: status.HTTP_406_NOT_ACCEPTABLE,
+    ConnectionFailed: status.HTTP_503_SERVICE_UNAVAILABLE,
+    BackendTimeout: status.HTTP_504_GATEWAY_TIMEOUT
+}
+
+jobs = JobManager(ERROR_STATUS)
+class FastJSONResponse(JSONResponse):
+    # orjson serializes several times faster, the standard encoder stays as fallback
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if INVENTORY_ENABLED:
+        inventory.start()
+    await docker.run(docker.backend.image_manager.warm)
+    pools.start()
+    if HISTORY_ENABLED:
+        history.start()
+    yield
+    logs.stop()
+    history.stop()
+    pools.stop()
+    inventory.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 origins = [
     "http://localhost.tiangolo.com",
@@ -35,6 +141,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(ResourceNotFound)
+async def resource_not_found_handler(request: Request, exc: ResourceNotFound):
+    # The index entry is stale if the backend no longer knows the resource
+    if "id" in request.path_params:
+        index.remove(request.path_params["id"])
+    return FastJSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": exc.message})
+
+@app.exception_handler(BackendTimeout)
+async def backend_timeout_handler(request: Request, exc: BackendTimeout):
+    return FastJSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content={"detail": exc.message})
+
+@app.exception_handler(JobLimitReached)
+async def job_limit_handler(request: Request, exc: JobLimitReached):
+    return FastJSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, content={"detail": exc.message},
+                            headers={"Retry-After": "5"})
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
@@ -44,7 +167,7 @@ async def login_for_access_token(
         scopes = str(form_data.scopes[0]).split('+')
     else: 
         scopes = form_data.scopes    
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+    user = await authenticate_user(user_store, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -64,33 +187,314 @@ async def read_users_me(
 ):
     return current_user
 
+@app.get("/stats/libvirt")
+async def get_libvirt_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return vm.backend.pool_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    for backend in [backend for host in hosts.select() for backend in (host.docker, host.vm)]:
+        stats = backend.stats()
+        executor_queued.labels(backend.name).set(stats["queued"])
+        executor_running.labels(backend.name).set(stats["running"])
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/backends")
+async def get_backend_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return [docker.stats(), vm.stats()]
+
+@app.get("/stats/inventory")
+async def get_inventory_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return inventory.stats()
+
+@app.get("/stats/telemetry")
+async def get_telemetry_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return telemetry.stats()
+
+@app.get("/stats/cache")
+async def get_cache_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return cache.stats()
+
+@app.get("/stats/logs")
+async def get_log_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return logs.stats()
+
+@app.get("/stats/history")
+async def get_history_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return history.stats()
+
 @app.get("/resources")
 async def get_list(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],    
-    type: Annotated[str, Query(description="docker container, docker images, kvm-qemu vms, kvm-qemu volumes")]
+    request: Request,
+    response: Response,
+    type: Annotated[str, Query(description="docker container, docker images, kvm-qemu vms, kvm-qemu volumes")],
+    stats: Annotated[str, Query(description="Only kvm-qemu vms: comma separated list of cpu, balloon, block, net")] = None,
+    state: Annotated[str, Query(alias="status", description="docker container: created, running, exited, ...; kvm-qemu vms: Running, Not Running, ...")] = None,
+    label: Annotated[str, Query(description="Only docker: key or key=value")] = None,
+    name: Annotated[str, Query(description="Name prefix")] = None,
+    ancestor: Annotated[str, Query(description="Only docker container: image the container is based on")] = None,
+    image: Annotated[str, Query(description="Only docker container: image name prefix")] = None,
+    reference: Annotated[str, Query(description="Only docker images: reference, e.g. nginx or nginx:1.*")] = None,
+    persistent: Annotated[bool, Query(description="Only kvm-qemu vms: persistent or transient domains")] = None,
+    pool: Annotated[str, Query(description="Only kvm-qemu volumes: storage pool name")] = None,
+    limit: Annotated[int, Query(description="Only docker container: newest n containers")] = None,
+    fields: Annotated[str, Query(description="Comma separated fields to return, docker also accepts inspect fields, e.g. State.StartedAt")] = None,
+    page_size: Annotated[int, Query(gt=0, description="Number of resources per page")] = None,
+    cursor: Annotated[str, Query(description="Value of the X-Next-Cursor header of the previous page")] = None,
+    since: Annotated[str, Query(description="Value of the X-Inventory-Version header of an earlier listing, only changes since then are returned")] = None
+):
+    try:
+        kind = parse_type(type)
+        columns = parse_fields(fields)
+        ndjson = "application/x-ndjson" in request.headers.get("accept", "")
+        filters = {"status": state, "name": name, "image": image, "persistent": persistent}
+        if_none_match = request.headers.get("if-none-match", "")
+        servable = INVENTORY_ENABLED and not needs_backend(kind, stats, label, ancestor, limit, columns, pool,
+                                                           reference)
+        snapshot = inventory.snapshot(kind) if servable else None
+        if since is not None:
+            return delta_listing(kind, since, servable, snapshot, columns, filters, if_none_match)
+
+        if snapshot is not None:
+            # Answered from the inventory, the version alone decides whether anything changed
+            version, rows = snapshot
+            etag = make_etag(version, sorted(request.query_params.multi_items()) + [ndjson])
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+            headers = {"ETag": etag, "X-Inventory-Version": version}
+            rows = filter_rows(kind, iterate(rows), **filters)
+        elif not (page_size or cursor or ndjson):
+            # Whole lists from the backend are shared and cached together with their content hash
+            async def load():
+                rows = open_listing(hosts.local, kind, stats, state, label, name, ancestor, limit, columns, pool,
+                                    reference)
+                rows = filter_rows(kind, rows, **filters)
+                rows = [project(row, columns) async for row in await peek(rows)]
+                return content_etag(rows), rows
+
+            etag, rows = await cache.get("list", ("list", hosts.local.name, kind, stats, state, label, name, 
+                                                  ancestor, image, reference, persistent, pool, limit,
+                                                  tuple(columns)),
+                                         [(hosts.local.name, kind)], load)
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+            return rows
+        else:
+            rows = open_listing(hosts.local, kind, stats, state, label, name, ancestor, limit, columns, pool,
+                                reference)
+            rows = filter_rows(kind, rows, **filters)
+            headers = {}
+        if page_size or cursor:
+            page, next_cursor = await paginate(kind, rows, page_size or DEFAULT_PAGE_SIZE, cursor)
+            if next_cursor:
+                headers["X-Next-Cursor"] = next_cursor
+            rows = iterate(page)
+        # Pull the first resource before answering so backend errors still map to a status code
+        rows = await peek(rows)
+        if ndjson:
+            return StreamingResponse(to_ndjson(rows, columns), media_type="application/x-ndjson",
+                                     headers=headers)
+        response.headers.update(headers)
+        return [project(row, columns) async for row in rows]
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+    except ArgumentNotFound as e2:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=e2.message)
+
+@app.get("/hosts")
+async def list_hosts(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return [dict(host.to_dict(), local=host is hosts.local) for host in hosts.select()]
+
+@app.get("/hosts/resources")
+async def get_host_list(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    request: Request,
+    type: Annotated[str, Query(description="docker container, docker images, kvm-qemu vms, kvm-qemu volumes")],
+    host: Annotated[str, Query(description="Comma separated host names, default all hosts")] = None,
+    state: Annotated[str, Query(alias="status", description="docker container: created, running, exited, ...; kvm-qemu vms: Running, Not Running, ...")] = None,
+    name: Annotated[str, Query(description="Name prefix")] = None,
+    fields: Annotated[str, Query(description="Comma separated fields to return")] = None
+):
+    # Every host is asked at once, hosts that fail or time out are reported instead of failing the request
+    try:
+        kind = parse_type(type)
+        columns = parse_fields(fields)
+        selected = hosts.select(host.split(",") if host else None)
+    except ArgumentNotFound as e1:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=e1.message)
+    except ResourceNotFound as e2:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e2.message)
+
+    async def collect(target):
+        rows = open_listing(target, kind, None, state, None, name, None, None, columns, None)
+        rows = filter_rows(kind, rows, status=state, name=name)
+        return [dict(project(row, columns), host=target.name, id=hosts.qualify(target, row[KEY_FIELDS[kind]]))
+                async for row in rows]
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        async def lines():
+            reports = {}
+            async for target, rows, report in hosts.fan_out(selected, collect):
+                reports[target.name] = dict(report, count=len(rows or ()))
+                for row in rows or ():
+                    yield json.dumps(row, default=str) + "\n"
+            yield json.dumps({"hosts": reports}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    resources = []
+    reports = {}
+    async for target, rows, report in hosts.fan_out(selected, collect):
+        reports[target.name] = dict(report, count=len(rows or ()))
+        resources += rows or ()
+    return {"resources": resources, "hosts": reports}
+
+@app.get("/resources/stats/stream")
+async def stream_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    ids: Annotated[str, Query(description="Comma separated resource ids or names")]
+):
+    resources = [await get_resource(id) for id in parse_ids(ids)]
+    return StreamingResponse(stats_events(resources), media_type="text/event-stream")
+
+@app.websocket("/resources/stats/ws")
+async def stream_stats_ws(
+    current_user: Annotated[User, Security(get_websocket_user, scopes=["basic"])],
+    websocket: WebSocket,
+    ids: Annotated[str, Query(description="Comma separated resource ids or names")]
+):
+    # Resolved like the SSE routes, a rejected id closes the socket before it is accepted
+    try:
+        resources = [await get_resource(id) for id in parse_ids(ids)]
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+    await websocket.accept()
+    try:
+        async for sample in telemetry.subscribe(resources):
+            await websocket.send_json(sample)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/resources/{id}/stats/stream")
+async def stream_resource_stats(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    id: str
+):
+    resources = [await get_resource(id)]
+    return StreamingResponse(stats_events(resources), media_type="text/event-stream")
+
+@app.get("/resources/{id}/history")
+async def get_history(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    id: str,
+    metric: Annotated[Literal[METRICS], Query(description="Recorded metric")] = "cpuPercent",
+    start: Annotated[datetime, Query(alias="from", description="Start of the range, default one hour ago")] = None,
+    end: Annotated[datetime, Query(alias="to", description="End of the range, default now")] = None,
+    step: Annotated[int, Query(gt=0, description="Seconds per returned point")] = None
 ):
-    if type in "docker container":
-        return docker.list_containers()
-    elif type in "docker images":
-        return docker.list_images()
-    elif type in "kvm-qemu vms":
-        return vm.list_vms()
-    elif type in "kvm-qemu volumes":
-        return vm.list_storage_vol()
+    backend, key = await get_resource(id)
+    end = end.timestamp() if end else datetime.now().timestamp()
+    start = start.timestamp() if start else end - 3600
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="from must be before to")
+    res = history.query((backend, key), metric, start, end, step)
+    if res is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No history recorded for " + id)
+    return {"id": key, **res}
+
+@app.get("/resources/{id}/logs")
+async def get_logs(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    id: str,
+    tail: Annotated[int, Query(ge=0, description="Only docker container: last n lines, default all")] = None,
+    since: Annotated[datetime, Query(description="Only docker container: lines logged after this time")] = None,
+    until: Annotated[datetime, Query(description="Only docker container: lines logged before this time")] = None,
+    follow: Annotated[bool, Query(description="Keep streaming new output, kvm-qemu consoles require it")] = False,
+    timestamps: Annotated[bool, Query(description="Only docker container: prefix lines with their time")] = False
+):
+    backend, key = await get_resource(id)
+    try:
+        chunks = await logs.open(backend, key, tail, since.timestamp() if since else None,
+                                 until.timestamp() if until else None, follow, timestamps)
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+    except ArgumentNotFound as e2:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=e2.message)
+    except ConnectionFailed as e3:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=e3.message)
+    return StreamingResponse(chunks, media_type="text/plain")
 
 @app.get("/resources/{id}")
 async def get_info(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],    
     id: str,
-    filter: Annotated[bool, Query(description="List Snapshots of VM")] = False
+    filter: Annotated[bool, Query(description="List Snapshots of VM")] = False,
+    fields: Annotated[str, Query(description="Comma separated dotted paths to return, e.g. State.Status,NetworkSettings.IPAddress or hardware_info.memory")] = None
 ):
-    if get_resource(id) == "docker":
-        return docker.get_container_info(id)
-    elif get_resource(id) == "kvm-qemu":
-        if filter:
-            return vm.list_snapshots(id)
-        else:
-            return vm.get_vm_info(id)
+    host, backend, key = await get_host_resource(id)
+    columns = parse_fields(fields)
+
+    async def load():
+        if backend == "docker":
+            return await host.docker.get_container_info(key, columns)
+        elif filter:
+            return await host.vm.list_snapshots(key)
+        return await host.vm.get_vm_info(key, columns)
+    # The inventory reports containers by their short id, key is the full one
+    tags = [(host.name, key), (host.name, key[:SHORT_ID_LENGTH])] if backend == "docker" else [(host.name, key)]
+    return await cache.get("info", ("info", host.name, key, filter, tuple(columns)), tags, load)
+
+@app.get("/resources/{id}/snapshots")
+async def get_snapshots(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],    
+    id: str,
+    limit: Annotated[int, Query(gt=0, description="Newest n snapshots")] = None,
+    since: Annotated[datetime, Query(description="Only snapshots created after this time")] = None
+):
+    key = await get_vm_resource(id)
+    try:
+        return await vm.list_snapshots(key, limit, since)
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+
+@app.get("/resources/{id}/snapshots/count")
+async def count_snapshots(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],    
+    id: str
+):
+    key = await get_vm_resource(id)
+    try:
+        return {"count": await vm.count_snapshots(key)}
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+
+@app.get("/resources/{id}/snapshots/tree")
+async def get_snapshot_tree(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],    
+    id: str
+):
+    key = await get_vm_resource(id)
+    try:
+        return await vm.get_snapshot_tree(key)
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
 
 @app.put("/resources/{id}/start")
 async def start_resource(
@@ -99,10 +503,8 @@ async def start_resource(
     revertSnapshot = None
 ):
     try:
-        if get_resource(id) == "docker":
-            return docker.start_container(id)
-        elif get_resource(id) == "kvm-qemu":
-            return vm.start_vm(id, revertSnapshot)
+        host, backend, key = await get_host_resource(id)
+        return await start_action(host, backend, key, {"revertSnapshot": revertSnapshot})
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ResourceAlreadyRunning as e2:
@@ -114,10 +516,8 @@ async def stop_resource(
     id: str
 ):
     try:
-        if get_resource(id) == "docker":
-            return docker.stop_container(id)
-        elif get_resource(id) == "kvm-qemu":
-            return vm.stop_vm(id)
+        host, backend, key = await get_host_resource(id)
+        return await stop_action(host, backend, key, {})
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ResourceNotRunning as e2:
@@ -129,10 +529,8 @@ async def restart_resource(
     id: str
 ):
     try:
-        if get_resource(id) == "docker":
-            return docker.restart_container(id)
-        elif get_resource(id) == "kvm-qemu":
-            return vm.reboot_vm(id)
+        host, backend, key = await get_host_resource(id)
+        return await restart_action(host, backend, key, {})
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ResourceNotRunning as e2:
@@ -146,30 +544,64 @@ async def remove_resource(
     deleteSnapshot: Annotated[str, Query(description="Delete snapshot instead of vm")] = None,
 ):
     try:
-        if get_resource(id) == "docker":
-            return docker.remove_container(id)
-        elif get_resource(id) == "kvm-qemu":
-            if deleteSnapshot:
-                return vm.deleteSnapshot(id, deleteSnapshot)
-            if len(vm.get_vm_snapshots(id)) == 0:
-                if deleteStorageVol:
-                    vm.delete_storage_vol(id)
-                return vm.delete_vm(id)
-            else: 
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, 
-                                    detail="Cannot delete inactive domain with " 
-                                        + str(len(vm.getDomainSnapshots(id)))+ " snapshots")
+        host, backend, key = await get_host_resource(id)
+        return await remove_action(host, backend, key, {"deleteStorageVol": deleteStorageVol,
+                                                        "deleteSnapshot": deleteSnapshot})
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ResourceRunning as e2:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e2.message)
 
+class ShutdownOptions(BaseModel):
+    save: bool = False
+    force: bool = False
+
+class RemoveOptions(BaseModel):
+    deleteSnapshot: str | None = None
+    deleteStorageVol: bool = True
+
+class NoOptions(BaseModel):
+    pass
+
+# Options are checked per item, a malformed one only fails its own item
+BATCH_OPTIONS = {"start": NoOptions, "stop": NoOptions, "restart": NoOptions,
+                 "shutdown": ShutdownOptions, "remove": RemoveOptions}
+
+class BatchItem(BaseModel):
+    id: str
+    action: Literal["start", "stop", "restart", "shutdown", "remove"]
+    options: dict = {}
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "id": "46b9a9cc-e6dc-4f96-9b65-5e57d8a4dcda",
+                "action": "shutdown",
+                "options": {"save": True}
+            }
+        }
+
+@app.post("/resources/batch")
+async def batch_resources(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],
+    items: List[BatchItem]
+):
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="At most " + str(MAX_BATCH_SIZE) + " items per batch")
+    return await asyncio.gather(*(run_batch_item(item) for item in items))
+
 @app.delete("/resources/docker/prune")
 async def prune_containers(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])]
 ):
     try:
-        return docker.prune_containers()
+        res = await docker.prune_containers()
+        deleted = res["Following containers sucessfully removed"].get("ContainersDeleted") or []
+        for key in deleted:
+            index.remove(key)
+        changed(hosts.local, ("containers",), *deleted)
+        return res
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
 
@@ -177,13 +609,21 @@ async def prune_containers(
 async def take_snapshot(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],   
     id: str,
-    snapshot_name: str
+    snapshot_name: str,
+    background: Annotated[bool, Query(description="Run as job and answer with 202 Accepted")] = False
 ):
-    get_resource()
+    key = await get_vm_resource(id)
+    if background:
+        return accepted(jobs.submit("snapshot", key, 
+                                    lambda job: track_libvirt_job(job, key, vm.create_snapshot(
+                                        key, snapshot_name, call_timeout=JOB_TIMEOUT)),
+                                    cancel=lambda: vm.abort_job(key)))
     try:
-        return vm.create_snapshot(id, snapshot_name)
+        return await vm.create_snapshot(key, snapshot_name)
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+    finally:
+        changed(hosts.local, ("domains",), key)
 
 @app.put("/resources/{id}/shutdown")
 async def shutdown_vm(
@@ -191,10 +631,16 @@ async def shutdown_vm(
     id: str,
     save: Annotated[bool, Query(description="Save VM for later use, priority over force command")] = False, 
     force: bool = False, 
+    background: Annotated[bool, Query(description="Run as job and answer with 202 Accepted")] = False
 ):
-    get_resource()
+    key = await get_vm_resource(id)
+    if background:
+        return accepted(jobs.submit("shutdown", key, 
+                                    lambda job: track_libvirt_job(job, key, vm.shutdown_vm(
+                                        key, save, force, call_timeout=JOB_TIMEOUT)),
+                                    cancel=(lambda: vm.abort_job(key)) if save else None))
     try:
-        return vm.shutdown_vm(id, save, force)
+        return await shutdown_action(hosts.local, "kvm-qemu", key, {"save": save, "force": force})
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ResourceNotRunning as e2:
@@ -204,10 +650,33 @@ async def shutdown_vm(
 async def run_container(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],
     obj: ContainerObj, 
-    image: str
+    image: str,
+    background: Annotated[bool, Query(description="Run as job and answer with 202 Accepted")] = False
 ):
+    cancelled = threading.Event()
+
+    async def run(job):
+        def report(progress):
+            job.progress = progress
+        try:
+            res = await docker.run(pools.claim_container, image, obj)
+            if res is None and job:
+                res = await docker.run_container(image, obj, report, cancelled, call_timeout=JOB_TIMEOUT)
+            elif res is None:
+                res = await docker.run_container(image, obj)
+        finally:
+            changed(hosts.local, ("containers", "images"))
+        created = res["Following container sucessfully created"]
+        index.add("docker", created["Id"], created["Name"].lstrip("/"))
+        return res
+
+    async def cancel():
+        cancelled.set()
+
+    if background:
+        return accepted(jobs.submit("run_container", image, run, cancel))
     try:
-        return docker.run_container(image, obj)
+        return await run(None)
     except APIError as e1:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
     except ImageNotFound as e2:
@@ -228,12 +697,29 @@ class Item(BaseModel):
         }})
 async def run_vm_xml(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],    
-    request: Request
+    request: Request,
+    background: Annotated[bool, Query(description="Run as job and answer with 202 Accepted")] = False
 ):
     content_type = request.headers['Content-Type']
     if content_type == "application/xml":
         body = await request.body()
-        res = vm.run_vm_xml(body)
+
+        async def run(job):
+            try:
+                res = await vm.run_vm_xml(body, call_timeout=JOB_TIMEOUT if job else None)
+            finally:
+                changed(hosts.local, ("domains",))
+            booted = res["Following guest sucessfully booted"]
+            index.add("kvm-qemu", booted["Id"], booted["Name"])
+            return res
+        if background:
+            return accepted(jobs.submit("run_vm_xml", None, run))
+        try:
+            res = await run(None)
+        except APIError as e1:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e1.message)
+        except ArgumentNotFound as e2:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e2.message)
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
                             detail=f'Content type {content_type} not supported')
@@ -242,23 +728,358 @@ async def run_vm_xml(
 @app.post("/resources/kvm-qemu/run/json")
 async def run_vm_json(
     current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],
-    obj: DomainObj
+    obj: DomainObj,
+    background: Annotated[bool, Query(description="Run as job and answer with 202 Accepted")] = False
 ):
+    if not obj.name:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="name is required")
+    if not obj.source_file and not obj.template:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Either source_file or template is required")
+
+    async def run(job):
+        try:
+            return await boot(job)
+        finally:
+            changed(hosts.local, ("domains", "volumes"))
+
+    async def boot(job):
+        timeout = JOB_TIMEOUT if job else None
+        res = await vm.run(pools.claim_vm, obj)
+        if res is not None:
+            booted = res["Following guest sucessfully booted"]
+            index.add("kvm-qemu", booted["Id"], booted["Name"], booted["Title"])
+            return res
+        if obj.cloud_init is not None:
+            await vm.create_seed_vol(obj.name, obj.cloud_init, call_timeout=timeout)
+        await vm.create_storage_vol(obj.name, obj.disk_size, obj.template, obj.full_clone, call_timeout=timeout)
+        inventory.invalidate("volumes")
+        res = await vm.run_vm_json(obj, call_timeout=timeout)
+        booted = res["Following guest sucessfully booted"]
+        index.add("kvm-qemu", booted["Id"], booted["Name"])
+        return res
+
+    if background:
+        return accepted(jobs.submit("run_vm_json", obj.name, run))
     try:
-        vm.create_storage_vol(obj.dict().get("name"))
-        return vm.run_vm_json(obj)
-    except APIError as e:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+        return await run(None)
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e1.message)
+    except ArgumentNotFound as e2:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e2.message)
+
+@app.get("/templates")
+async def list_templates(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    try:
+        return await vm.list_templates()
+    except ArgumentNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
 
-def get_resource(id):
-    res = None
+@app.get("/images")
+async def get_images(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
     try:
-        if vm.get_vm(id):
-            res = "kvm-qemu"
-    except ResourceNotFound:
+        return await docker.run(docker.backend.image_manager.stats)
+    except APIError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e.message)
+
+@app.post("/images/pull")
+async def pull_image(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],
+    image: str
+):
+    # Concurrent requests for the same image follow one pull
+    async def events():
         try:
-            if docker.get_container(id):
-                res = "docker"
-        except ResourceNotFound as e:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+            async for progress in docker.stream(docker.backend.image_manager.follow, image):
+                yield "event: progress\ndata: " + json.dumps(progress) + "\n\n"
+            changed(hosts.local, ("images",))
+            yield "event: done\ndata: " + json.dumps({"image": image}) + "\n\n"
+        except (APIError, ImageNotFound) as e:
+            yield "event: error\ndata: " + json.dumps({"image": image, "detail": e.message}) + "\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/images/evict")
+async def evict_images(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])]
+):
+    try:
+        removed = await docker.run(docker.backend.image_manager.evict)
+        changed(hosts.local, ("images",))
+        return {"removed": removed}
+    except APIError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e.message)
+
+@app.get("/pools")
+async def get_pools(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return pools.stats()
+
+@app.get("/jobs")
+async def list_jobs(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return jobs.list()
+
+@app.get("/jobs/events")
+async def job_events(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])]
+):
+    return StreamingResponse(jobs.events(), media_type="text/event-stream")
+
+@app.get("/jobs/{id}")
+async def get_job(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    id: str
+):
+    return find_job(id).to_dict()
+
+@app.get("/jobs/{id}/wait")
+async def wait_job(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["basic"])],
+    id: str,
+    timeout: Annotated[float, Query(gt=0, le=120, description="Seconds to wait for the job to finish")] = 30
+):
+    job = await jobs.wait(find_job(id), timeout)
+    return job.to_dict()
+
+@app.delete("/jobs/{id}")
+async def cancel_job(
+    current_user: Annotated[User, Security(get_current_active_user, scopes=["advanced"])],
+    id: str
+):
+    job = find_job(id)
+    try:
+        if not await jobs.cancel(job):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, 
+                                detail="Job " + id + " cannot be cancelled in state " + job.status)
+    except APIError as e1:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e1.message)
+    return job.to_dict()
+
+def find_job(id):
+    job = jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job " + id + " not found")
+    return job
+
+def accepted(job):
+    return FastJSONResponse(status_code=status.HTTP_202_ACCEPTED, content=jsonable_encoder(job.to_dict()),
+                        headers={"Location": "/jobs/" + job.id})
+
+async def track_libvirt_job(job, key, call):
+    # Polls libvirt's job stats while the blocking call runs on the executor
+    task = asyncio.ensure_future(call)
+    try:
+        while True:
+            done, pending = await asyncio.wait({task}, timeout=PROGRESS_INTERVAL)
+            if done:
+                return task.result()
+            try:
+                job.progress = await vm.get_job_progress(key)
+            except (APIError, ResourceNotFound, BackendTimeout):
+                pass
+    finally:
+        changed(hosts.local, ("domains",), key)
+
+def changed(host, kinds, *keys):
+    # Drops cached lists of the given kinds and cached info of the given resources
+    cache.invalidate(*((host.name, kind) for kind in kinds), *((host.name, key) for key in keys))
+
+async def start_action(host, backend, key, options):
+    try:
+        if backend == "docker":
+            return await host.docker.start_container(key)
+        return await host.vm.start_vm(key, options.get("revertSnapshot"))
+    finally:
+        changed(host, (LIST_KINDS[backend],), key)
+
+async def stop_action(host, backend, key, options):
+    try:
+        if backend == "docker":
+            return await host.docker.stop_container(key)
+        return await host.vm.stop_vm(key)
+    finally:
+        changed(host, (LIST_KINDS[backend],), key)
+
+async def restart_action(host, backend, key, options):
+    try:
+        if backend == "docker":
+            return await host.docker.restart_container(key)
+        return await host.vm.reboot_vm(key)
+    finally:
+        changed(host, (LIST_KINDS[backend],), key)
+
+async def shutdown_action(host, backend, key, options):
+    if backend != "kvm-qemu":
+        raise ArgumentNotFound("shutdown is only available for kvm-qemu vms")
+    try:
+        return await host.vm.shutdown_vm(key, options.get("save", False), options.get("force", False))
+    finally:
+        changed(host, ("domains",), key)
+
+async def remove_action(host, backend, key, options):
+    try:
+        return await remove_backend_resource(host, backend, key, options)
+    finally:
+        changed(host, (LIST_KINDS[backend], "volumes"), key)
+
+async def remove_backend_resource(host, backend, key, options):
+    if backend == "docker":
+        res = await host.docker.remove_container(key)
+        host.index.remove(key)
+        return res
+    if options.get("deleteSnapshot"):
+        return await host.vm.delete_snapshot(key, options["deleteSnapshot"])
+    snapshots = await host.vm.count_snapshots(key)
+    if snapshots != 0:
+        raise APIError("Cannot delete inactive domain with " + str(snapshots) + " snapshots")
+    if options.get("deleteStorageVol", True):
+        await host.vm.delete_storage_vol(key)
+        if host is hosts.local:
+            inventory.invalidate("volumes")
+    res = await host.vm.delete_vm(key)
+    host.index.remove(key)
     return res
+
+ACTIONS = {
+    "start": start_action,
+    "stop": stop_action,
+    "restart": restart_action,
+    "shutdown": shutdown_action,
+    "remove": remove_action
+}
+
+async def run_batch_item(item):
+    result = {"id": item.id, "action": item.action}
+    try:
+        options = BATCH_OPTIONS[item.action](**item.options).dict()
+    except ValidationError as e:
+        result["status"] = status.HTTP_400_BAD_REQUEST
+        result["detail"] = "; ".join(".".join(str(part) for part in error["loc"]) + ": " + error["msg"]
+                                     for error in e.errors())
+        return result
+    try:
+        host, backend, key = await hosts.resolve(item.id)
+        async with batch_limits[backend]:
+            result["result"] = await ACTIONS[item.action](host, backend, key, options)
+        result["status"] = status.HTTP_200_OK
+    except tuple(ERROR_STATUS) as e:
+        if isinstance(e, ResourceNotFound):
+            index.remove(item.id)
+        result["status"] = ERROR_STATUS[type(e)]
+        result["detail"] = e.message
+    except Exception as e:
+        # The other items have run already, their results must still reach the client
+        result["status"] = status.HTTP_500_INTERNAL_SERVER_ERROR
+        result["detail"] = getattr(e, "message", str(e))
+    return result
+
+def needs_backend(kind, stats, label, ancestor, limit, columns, pool, reference=None):
+    # Filters and fields only the backend knows, the inventory cannot answer these
+    inspect = [field for field in columns if kind in SUMMARY_FIELDS and field not in SUMMARY_FIELDS[kind]]
+    if kind == "containers":
+        return bool(label or ancestor or limit or inspect)
+    elif kind == "images":
+        return bool(label or reference or inspect)
+    elif kind == "domains":
+        return bool(stats)
+    return bool(pool)
+
+def open_listing(host, kind, stats, state, label, name, ancestor, limit, columns, pool, reference=None):
+    # Serve from the inventory unless the request needs something only the backend knows
+    direct = needs_backend(kind, stats, label, ancestor, limit, columns, pool, reference)
+    if kind == "containers":
+        inspect = [field for field in columns if field not in SUMMARY_FIELDS[kind]]
+        if direct:
+            filters = {key: value for key, value in 
+                       {"status": state, "label": label, "ancestor": ancestor,
+                        "name": "^/" + re.escape(name) if name else None}.items() if value}
+            return host.docker.stream(host.docker.backend.iter_containers, filters, limit, inspect)
+        return list_resources(host, kind, host.docker.backend.iter_containers)
+    elif kind == "images":
+        inspect = [field for field in columns if field not in SUMMARY_FIELDS[kind]]
+        if direct:
+            filters = {key: value for key, value in {"label": label, "reference": reference}.items() if value}
+            return host.docker.stream(host.docker.backend.iter_images, filters or None, inspect)
+        return list_resources(host, kind, host.docker.backend.iter_images)
+    elif kind == "domains":
+        if direct:
+            host.vm.backend.parse_stats_groups(stats)
+            return host.vm.stream(host.vm.backend.iter_vms, stats)
+        return list_resources(host, kind, host.vm.backend.iter_vms)
+    if direct:
+        return host.vm.stream(host.vm.backend.iter_storage_vol, pool)
+    return list_resources(host, kind, host.vm.backend.iter_storage_vol)
+
+def delta_listing(kind, since, servable, snapshot, columns, filters, if_none_match):
+    if not servable:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="since needs a listing the inventory can answer: INVENTORY=1, "
+                                   "no stats, label, ancestor, reference, limit, pool or inspect fields")
+    if snapshot is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Inventory is resynchronizing, retry shortly")
+    # Clients apply deltas by key, projections always keep it
+    if columns and KEY_FIELDS[kind] not in columns:
+        columns = columns + [KEY_FIELDS[kind]]
+    generation = inventory.parse_version(since)
+    changes = inventory.changes(kind, generation) if generation is not None else None
+    if changes is None:
+        # Unknown, foreign or expired version: the client starts over with the full list
+        version, rows = snapshot
+        body = {"version": version, "reset": True,
+                "added": [project(row, columns) for row in rows if matches(kind, row, **filters)],
+                "changed": [], "removed": []}
+    else:
+        version, changes = changes
+        body = {"version": version, "reset": False, **delta_rows(kind, changes, columns, **filters)}
+    etag = make_etag(version, [since, kind, columns, filters])
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return FastJSONResponse(content=jsonable_encoder(body), headers={"ETag": etag, "X-Inventory-Version": version})
+
+def list_resources(host, kind, fallback):
+    # Only the local host has an event driven inventory
+    rows = inventory.list(kind) if host is hosts.local else None
+    if rows is None:
+        backend = host.docker if KINDS[kind] == "docker" else host.vm
+        return backend.stream(fallback)
+    return iterate(rows)
+
+def parse_ids(ids):
+    ids = [id.strip() for id in ids.split(",") if id.strip()]
+    if not ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids must not be empty")
+    return ids
+
+async def stats_events(resources):
+    async for sample in telemetry.subscribe(resources):
+        yield "event: " + ("error" if "error" in sample else "stats") + "\ndata: " + json.dumps(sample) + "\n\n"
+
+async def get_resource(id):
+    host, key = hosts.split(id)
+    if host is not None and host is not hosts.local:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Only available for resources on the local host")
+    try:
+        return await index.resolve(key)
+    except ResourceNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+
+async def get_host_resource(id):
+    try:
+        return await hosts.resolve(id)
+    except ResourceNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+
+async def get_vm_resource(id):
+    backend, key = await get_resource(id)
+    if backend != "kvm-qemu":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Requested resource is not a kvm-qemu vm")
+    return key